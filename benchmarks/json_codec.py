@@ -0,0 +1,58 @@
+"""Compares how quickly each available JSON codec encodes the request bodies
+of conversations of various lengths, and decodes the completions the API sends
+back.
+
+Run with ``python benchmarks/json_codec.py``.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from oratio import JSONCodec, OrjsonCodec, UjsonCodec, orjson, ujson
+
+def request_body(turns):
+    """Creates the body of a chat completion request for a conversation with
+    the given number of turns, with messages of realistic length."""
+
+    messages = [{"role": "system", "content": "You are a helpful assistant. " * 10}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Question {i}: " + "Could you explain why? " * 8})
+        messages.append({"role": "assistant", "content": f"Answer {i}: " + "Here is the reason, with detail. — " * 30})
+    return {"model": "gpt-4o", "temperature": 0.7, "messages": messages}
+
+
+def completion():
+    """Creates the body of a chat completion response."""
+
+    return JSONCodec().dumps({
+        "id": "chatcmpl-0123456789", "object": "chat.completion", "created": 1700000000,
+        "model": "gpt-4o-2024-08-06", "system_fingerprint": "fp_0123456789",
+        "choices": [{
+            "index": 0, "finish_reason": "stop", "logprobs": None,
+            "message": {"role": "assistant", "content": "Here is the reason, with detail. " * 60},
+        }],
+        "usage": {"prompt_tokens": 5000, "completion_tokens": 400, "total_tokens": 5400},
+    })
+
+
+def time_per_call(function, arg, number):
+    """Returns the mean microseconds per call of a function."""
+
+    return min(timeit.repeat(lambda: function(arg), number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == "__main__":
+    codecs = [JSONCodec()]
+    if ujson: codecs.append(UjsonCodec())
+    if orjson: codecs.append(OrjsonCodec())
+    response = completion()
+    print(f"{'':24}" + "".join(f"{codec.name:>12}" for codec in codecs))
+    for turns in (1, 10, 50, 200):
+        body = request_body(turns)
+        size = len(JSONCodec().dumps(body)) // 1024
+        times = [time_per_call(codec.dumps, body, 200) for codec in codecs]
+        print(f"{f'encode {turns} turns ({size}KB)':24}" + "".join(f"{t:>10.1f}us" for t in times))
+    times = [time_per_call(codec.loads, response, 2000) for codec in codecs]
+    print(f"{'decode completion':24}" + "".join(f"{t:>10.1f}us" for t in times))
@@ -0,0 +1,76 @@
+"""Measures the memory each message in a conversation takes up, comparing
+oratio's slotted Message and Response classes with equivalent classes which
+have an instance dictionary, as they did before.
+
+The message text itself is allocated before measuring, as it costs the same
+either way - what is measured is the overhead of the objects around it. Roles
+are created fresh for each message, as they would be when decoded from JSON.
+
+Run with ``python benchmarks/memory.py [messages]``.
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from oratio import Message, Response
+
+class DictResponse:
+    def __init__(self, json):
+        self.id = json["id"]
+        self.created = json["created"]
+        self.choices = [choice["message"]["content"] for choice in json["choices"]]
+        self.prompt_tokens_used = json["usage"]["prompt_tokens"]
+        self.completion_tokens_used = json["usage"]["completion_tokens"]
+        self.tokens_used = json["usage"]["total_tokens"]
+        self.message = self.choices[0]
+
+
+
+class DictMessage:
+    def __init__(self, role, content, response=None):
+        self.role = role
+        self.content = content
+        self.response = response
+
+
+
+def completions(count):
+    """Creates the JSON data of some completions, as the API would send it."""
+
+    return [{
+        "id": f"chatcmpl-{i:020d}",
+        "created": 1700000000 + i,
+        "choices": [{"message": {"role": "assistant", "content": f"Reply {i} " * 20}}],
+        "usage": {"prompt_tokens": 100 + i, "completion_tokens": 50, "total_tokens": 150 + i},
+    } for i in range(count)]
+
+
+def measure(message_class, response_class, turns):
+    """Builds a conversation's worth of messages and returns the bytes
+    allocated per message."""
+
+    prompts = [f"Question {i} " * 10 for i in range(turns)]
+    data = completions(turns)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = []
+    for prompt, json in zip(prompts, data):
+        role = "".join(["us", "er"]) # A fresh string, as if decoded from JSON
+        messages.append(message_class(role, prompt))
+        response = response_class(json)
+        messages.append(message_class("assistant", response.message, response))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / len(messages)
+
+
+if __name__ == "__main__":
+    turns = int(sys.argv[1]) // 2 if len(sys.argv) > 1 else 50000
+    old = measure(DictMessage, DictResponse, turns)
+    new = measure(Message, Response, turns)
+    print(f"Messages: {turns * 2}")
+    print(f"Instance dictionaries: {old:.0f} bytes per message")
+    print(f"Slots:                 {new:.0f} bytes per message")
+    print(f"Saving:                {1 - new / old:.0%}")
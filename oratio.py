@@ -1,189 +1,3911 @@
+import re
+import abc
+import sys
+import json
 import time
 import random
+import socket
+import asyncio
+import threading
+import email.utils
+import functools
+import hashlib
+import sqlite3
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import MutableSequence
 import requests
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed
+from requests.adapters import HTTPAdapter
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+MODEL_METADATA = {
+    "gpt-3.5-turbo": {"context_window": 16385, "input_price": 0.5, "output_price": 1.5},
+    "gpt-3.5-turbo-instruct": {"context_window": 4096, "input_price": 1.5, "output_price": 2},
+    "gpt-4": {"context_window": 8192, "input_price": 30, "output_price": 60},
+    "gpt-4-32k": {"context_window": 32768, "input_price": 60, "output_price": 120},
+    "gpt-4-turbo": {"context_window": 128000, "input_price": 10, "output_price": 30},
+    "gpt-4o": {"context_window": 128000, "input_price": 2.5, "output_price": 10},
+    "gpt-4o-mini": {"context_window": 128000, "input_price": 0.15, "output_price": 0.6},
+    "gpt-4.1": {"context_window": 1047576, "input_price": 2, "output_price": 8},
+    "gpt-4.1-mini": {"context_window": 1047576, "input_price": 0.4, "output_price": 1.6},
+    "gpt-4.1-nano": {"context_window": 1047576, "input_price": 0.1, "output_price": 0.4},
+    "o1": {"context_window": 200000, "input_price": 15, "output_price": 60},
+    "o1-mini": {"context_window": 128000, "input_price": 1.1, "output_price": 4.4},
+    "o3": {"context_window": 200000, "input_price": 2, "output_price": 8},
+    "o3-mini": {"context_window": 200000, "input_price": 1.1, "output_price": 4.4},
+    "o4-mini": {"context_window": 200000, "input_price": 1.1, "output_price": 4.4},
+}
+
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+BASE_URL = "https://api.openai.com/v1/"
+DEFAULT = object()
+
+def create_session(pool_size=10):
+    """Creates a keep-alive HTTP session which holds open connections to the
+    API between requests, rather than performing a fresh TCP and TLS handshake
+    for each one. A session can be shared between several users so that they
+    draw on one connection pool.
+
+    :param int pool_size: The number of connections to keep open per host.
+    :rtype: requests.Session
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class JSONCodec:
+    """Encodes and decodes the JSON sent to and received from the API, using
+    the standard library. Output is compact, and the same data always encodes
+    to the same bytes.
+    """
+
+    name = "json"
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
+    
+
+    def dumps(self, data):
+        """Encodes data as JSON.
+
+        :param data: The data to encode.
+        :rtype: bytes
+        """
+
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+    
+
+    def loads(self, data):
+        """Decodes JSON.
+
+        :param data: The JSON as bytes or a string.
+        :rtype: dict or list
+        """
+
+        return json.loads(data)
+
+
+
+class OrjsonCodec(JSONCodec):
+    """Encodes and decodes JSON using orjson, which is several times faster
+    than the standard library."""
+
+    name = "orjson"
+
+    def dumps(self, data):
+        return orjson.dumps(data)
+    
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+
+class UjsonCodec(JSONCodec):
+    """Encodes and decodes JSON using ujson, which is faster than the standard
+    library."""
+
+    name = "ujson"
+
+    def dumps(self, data):
+        return ujson.dumps(
+            data, ensure_ascii=False, escape_forward_slashes=False
+        ).encode()
+    
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+
+def default_codec():
+    """Gets the fastest JSON codec available - orjson if it is installed, then
+    ujson, and then the standard library.
+
+    :rtype: JSONCodec
+    """
+
+    if orjson: return OrjsonCodec()
+    if ujson: return UjsonCodec()
+    return JSONCodec()
+
+
+CODEC = default_codec()
+
+def loads(data):
+    """Decodes JSON with the default codec.
+
+    :param data: The JSON as bytes or a string.
+    :rtype: dict or list
+    """
+
+    return CODEC.loads(data)
+
+
+def run_in_thread(function, *args, **kwargs):
+    """Calls a function in a new daemon thread, returning a future for its
+    result. Unlike a thread pool, this never queues the call behind others.
+
+    :param function: The function to call.
+    :rtype: concurrent.futures.Future
+    """
+
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def discard_response(future):
+    """Closes the HTTP response of a request which is no longer wanted, once
+    it has arrived, so that its connection is released.
+
+    :param future: The future or task of the request.
+    """
+
+    if future.cancelled() or future.exception() is not None: return
+    response = future.result()
+    if hasattr(response, "release"):
+        response.release()
+    else:
+        response.close()
+
+
+def close_response(response):
+    """Closes a streamed HTTP response from another thread than the one reading
+    it. Its socket is shut down first, as closing alone doesn't wake a read
+    which is blocked waiting for data.
+
+    :param requests.Response response: The response to close.
+    """
+
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    sock = getattr(getattr(fp, "raw", None), "_sock", None) \
+        or getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def wait_for_future(future, deadline=None, cancel=None):
+    """Waits for a future to finish, giving up if the deadline passes or the
+    token is cancelled first - in which case :py:class:`DeadlineError` or
+    :py:class:`Cancelled` is raised.
+
+    :param concurrent.futures.Future future: The future to wait for.
+    :param float deadline: The monotonic time to give up at, if any.
+    :param CancelToken cancel: A token for giving up.
+    """
+
+    if future.done(): return
+    finished = threading.Event()
+    future.add_done_callback(lambda _: finished.set())
+    if cancel: cancel.on_cancel(finished.set)
+    try:
+        finished.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+    finally:
+        if cancel: cancel.remove(finished.set)
+    if future.done(): return
+    if cancel: cancel.check()
+    raise DeadlineError("The request took longer than its total timeout")
+
+
+
+def decode_event(line, codec=CODEC):
+    """Takes a line of a server-sent event stream and returns the JSON data it
+    carries, or ``None`` if the line has no data. The ``[DONE]`` marker which
+    ends a completion stream is returned as-is.
+
+    :param str line: The line to decode.
+    :param JSONCodec codec: The codec to decode the data with.
+    :rtype: dict or str
+    """
+
+    if isinstance(line, bytes): line = line.decode()
+    line = line.strip()
+    if not line.startswith("data:"): return None
+    data = line[5:].strip()
+    if data == "[DONE]": return data
+    return codec.loads(data)
+
+
+def merge_chunk(completion, chunk):
+    """Folds one chunk of a streamed completion into a completion dictionary,
+    which builds up into the same shape as a non-streamed completion. The text
+    the chunk adds to the first choice is returned.
+
+    :param dict completion: The completion built so far.
+    :param dict chunk: The chunk to add.
+    :rtype: str
+    """
+
+    completion["id"] = chunk["id"]
+    completion["created"] = chunk["created"]
+    if chunk.get("usage"): completion["usage"] = chunk["usage"]
+    text = ""
+    for choice in chunk["choices"]:
+        while len(completion["choices"]) <= choice["index"]:
+            completion["choices"].append({"message": {"role": "assistant", "content": ""}})
+        delta = choice["delta"].get("content") or ""
+        completion["choices"][choice["index"]]["message"]["content"] += delta
+        if choice["index"] == 0: text += delta
+    return text
+
+
+def read_usage(body):
+    """Reads just the ``usage`` object from the raw body of a completion,
+    without decoding the rest of it. The API puts it last, and a quote can't
+    appear unescaped inside a JSON string, so the last ``"usage"`` followed
+    by a colon is the completion's own. ``None`` is returned if it can't be
+    read this way.
+
+    :param body: The raw body, as bytes or a string.
+    :rtype: dict
+    """
+
+    key = b'"usage"' if isinstance(body, bytes) else '"usage"'
+    start = body.rfind(key)
+    if start < 0: return None
+    tail = body[start + len(key):]
+    if isinstance(tail, bytes): tail = tail.decode(errors="replace")
+    tail = tail.lstrip()
+    if not tail.startswith(":"): return None
+    try:
+        usage, _ = json.JSONDecoder().raw_decode(tail[1:].lstrip())
+    except ValueError:
+        return None
+    return usage if isinstance(usage, dict) and "prompt_tokens" in usage else None
+
+
+def estimate_tokens(json):
+    """Makes a rough estimate of the number of tokens a request will use, before
+    it is sent, from the length of its messages and the completion tokens it
+    asks for.
+
+    :param dict json: The request body.
+    :rtype: int
+    """
+
+    if not json or "messages" not in json: return 0
+    characters = sum(len(message["content"] or "") for message in json["messages"])
+    prompt_tokens = characters // 4 + 4 * len(json["messages"]) + 3
+    return prompt_tokens + json.get("max_tokens", 0)
+
+
+
+def parse_duration(text):
+    """Parses a duration in the format OpenAI uses for its rate limit reset
+    headers, such as ``"20ms"``, ``"1s"`` or ``"6m0.5s"``, into seconds.
+
+    :param str text: The duration to parse.
+    :rtype: float
+    """
+
+    seconds, number = 0, ""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    i = 0
+    while i < len(text):
+        if text[i].isdigit() or text[i] == ".":
+            number += text[i]
+            i += 1
+            continue
+        unit = "ms" if text[i:i + 2] == "ms" else text[i]
+        seconds += float(number) * units[unit]
+        number = ""
+        i += len(unit)
+    return seconds + float(number or 0)
+
+
+
+def model_metadata(model, table=None):
+    """Gets what is known about a model - its context window in tokens, and its
+    price in dollars per million input and output tokens. Dated snapshots of a
+    model (``gpt-4o-2024-08-06`` for example) share the metadata of the model
+    they are a snapshot of. An empty dictionary is returned for unknown models.
+
+    :param str model: The ID of the model.
+    :param dict table: The metadata to look in, if not the bundled table.
+    :rtype: dict
+    """
+
+    table = MODEL_METADATA if table is None else table
+    while model:
+        if model in table: return table[model]
+        model = model.rpartition("-")[0]
+    return {}
+
+
+def context_window(model):
+    """Gets the most tokens a model can take in one request, or ``None`` if the
+    model isn't known.
+
+    :param str model: The ID of the model.
+    :rtype: int
+    """
+
+    return model_metadata(model).get("context_window")
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Gets the tiktoken encoding used by a model, falling back to the encoding
+    of recent models if the model isn't known.
+
+    :param str model: The ID of the model.
+    :rtype: tiktoken.Encoding
+    """
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model=None):
+    """Counts the tokens in a piece of text. This uses the model's own
+    tokenizer if ``tiktoken`` is installed, and otherwise estimates the count
+    as one token per four characters.
+
+    :param str text: The text to count the tokens of.
+    :param str model: The ID of the model the text is for.
+    :rtype: int
+    """
+
+    if not text: return 0
+    if tiktoken is None: return (len(text) + 3) // 4
+    return len(get_encoding(model or "gpt-4o").encode(text, disallowed_special=()))
+
+
+
+class ContextWindowError(Exception):
+    """Raised when a request would have more tokens than the model can take, so
+    that it is caught before being sent."""
+
+
+
+class Cancelled(Exception):
+    """Raised when a request is abandoned because its
+    :py:class:`CancelToken` was cancelled."""
+
+
+
+class DeadlineError(requests.Timeout):
+    """Raised when a call takes longer than its total timeout."""
+
+
+
+class APIError(Exception):
+    """Raised when the API responds with an error status.
+
+    :param int status: The HTTP status code.
+    :param str message: The error message the API gave.
+    :param dict headers: The headers of the error response.
+    :param str type: The type of error the API gave, if any.
+    :param str code: The error code the API gave, if any.
+    """
+
+    def __init__(self, status, message, headers=None, type=None, code=None):
+        Exception.__init__(self, f"{status}: {message}")
+        self.status = status
+        self.message = message
+        self.headers = dict(headers or {})
+        self.type = type
+        self.code = code
+    
+
+    @property
+    def quota_exhausted(self):
+        """Whether the error is because the account has run out of credit,
+        rather than being rate limited - which waiting won't fix.
+
+        :rtype: bool
+        """
+
+        return "insufficient_quota" in (self.type, self.code)
+    
+
+    @staticmethod
+    def from_body(status, body, headers=None):
+        """Creates an error from the raw body of an error response, which is
+        usually JSON but may not be if it came from a proxy.
+
+        :param int status: The HTTP status code.
+        :param bytes body: The body of the response.
+        :param dict headers: The headers of the response.
+        :rtype: APIError
+        """
+
+        try:
+            error = json.loads(body)["error"]
+            message = error["message"]
+        except Exception:
+            message = body.decode(errors="replace")[:200] if body else ""
+            return APIError(status, message, headers)
+        return APIError(status, message, headers, error.get("type"), error.get("code"))
+
+
+
+class Timeout:
+    """Limits on how long a request can take. The connect and read timeouts
+    stop a request hanging on a stalled connection - the read timeout being
+    the longest wait for any data, not for the whole response. The total
+    timeout limits the whole call, including any retries, and for a stream
+    includes reading every event.
+
+    :param float connect: The longest wait to connect, in seconds.
+    :param float read: The longest wait for data from the server, in seconds.
+    :param float total: The longest time for the whole call, in seconds.
+    """
+
+    def __init__(self, connect=10, read=600, total=None):
+        self.connect = connect
+        self.read = read
+        self.total = total
+    
+
+    def __repr__(self):
+        return f"Timeout(connect={self.connect}, read={self.read}, total={self.total})"
+    
+
+    @staticmethod
+    def of(value):
+        """Makes a timeout from what is given - a timeout, a number of seconds
+        for both the connect and read timeouts, or a (connect, read) pair, as
+        ``requests`` takes them.
+
+        :param value: The timeout, if any.
+        :rtype: Timeout
+        """
+
+        if value is None or isinstance(value, Timeout): return value
+        if isinstance(value, tuple): return Timeout(*value)
+        return Timeout(value, value)
+    
+
+    def deadline(self):
+        """Gets the monotonic time a call starting now must finish by, or
+        ``None`` if there is no total timeout.
+
+        :rtype: float
+        """
+
+        return None if self.total is None else time.monotonic() + self.total
+    
+
+    def for_requests(self):
+        """The timeout in the form ``requests`` takes.
+
+        :rtype: tuple
+        """
+
+        return (self.connect, self.read)
+    
+
+    def for_aiohttp(self):
+        """The timeout in the form ``aiohttp`` takes.
+
+        :rtype: aiohttp.ClientTimeout
+        """
+
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.connect, sock_read=self.read)
+
+
+
+class CancelToken:
+    """Lets one thread abandon requests that another is waiting on. Pass the
+    token to the calls which should be abandoned, and call :py:meth:`cancel`
+    from anywhere - those calls then raise :py:class:`Cancelled` straight
+    away, and any stream they are reading is closed. A token stays cancelled
+    once it has been.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"CancelToken({'cancelled' if self.cancelled else 'active'})"
+    
+
+    @property
+    def cancelled(self):
+        """Whether the token has been cancelled.
+
+        :rtype: bool
+        """
+
+        return self.event.is_set()
+    
+
+    def cancel(self):
+        """Cancels the token, abandoning the calls which were given it."""
+
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks: callback()
+    
+
+    def on_cancel(self, callback):
+        """Registers a function to call when the token is cancelled - straight
+        away if it already has been.
+
+        :param callback: The function to call.
+        """
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+    
+
+    def remove(self, callback):
+        """Unregisters a function registered with :py:meth:`on_cancel`.
+
+        :param callback: The function to unregister.
+        """
+
+        with self.lock:
+            if callback in self.callbacks: self.callbacks.remove(callback)
+    
+
+    def wait(self, seconds):
+        """Sleeps for a number of seconds, waking early if the token is
+        cancelled.
+
+        :param float seconds: How long to sleep for.
+        """
+
+        self.event.wait(seconds)
+    
+
+    def check(self):
+        """Raises :py:class:`Cancelled` if the token has been cancelled."""
+
+        if self.cancelled: raise Cancelled("The request was cancelled")
+
+
+
+class RetryPolicy:
+    """Decides whether a failed request should be tried again, and how long to
+    wait before doing so.
+
+    Rate limit errors, server errors and dropped connections are retried, but
+    other errors (a bad request, an invalid key or an account out of credit,
+    for example) are raised straight away. Where the API says when to retry, through ``Retry-After`` or
+    its rate limit reset headers, that is used - otherwise waits grow
+    exponentially, with random jitter so that many clients do not all retry at
+    the same moment. No retry is made that would finish after the deadline.
+
+    :param int attempts: The most times to try a request in total.
+    :param float backoff: The base wait in seconds, doubled on each retry.
+    :param float max_backoff: The longest wait between tries, in seconds.
+    :param float deadline: The longest time to spend on one call, in seconds.
+    """
+
+    RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30, deadline=120):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+    
+
+    def __repr__(self):
+        return f"RetryPolicy(attempts={self.attempts}, deadline={self.deadline})"
+    
+
+    def is_retryable(self, error):
+        """Works out whether an error is likely to be transient, so that trying
+        again could succeed.
+
+        :param Exception error: The error raised by the request.
+        :rtype: bool
+        """
+
+        if isinstance(error, APIError):
+            return error.status in self.RETRYABLE_STATUSES and not error.quota_exhausted
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        if aiohttp and isinstance(error, aiohttp.ClientConnectionError):
+            return True
+        return isinstance(error, asyncio.TimeoutError)
+    
+
+    def suggested_wait(self, error):
+        """Gets the wait the API asked for in the headers of an error response,
+        if it gave one.
+
+        :param Exception error: The error raised by the request.
+        :rtype: float
+        """
+
+        headers = {k.lower(): v for k, v in getattr(error, "headers", {}).items()}
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                date = email.utils.parsedate_to_datetime(value)
+                return max(date.timestamp() - time.time(), 0)
+        waits = [
+            parse_duration(headers[f"x-ratelimit-reset-{kind}"])
+            for kind in ("requests", "tokens")
+            if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+            and f"x-ratelimit-reset-{kind}" in headers
+        ]
+        return max(waits) if waits else None
+    
+
+    def wait(self, error, attempt, start):
+        """Gets the number of seconds to wait before retrying a failed request,
+        or ``None`` if it should not be retried.
+
+        :param Exception error: The error raised by the request.
+        :param int attempt: How many retries have been made already.
+        :param float start: The monotonic time the call started at.
+        :rtype: float
+        """
+
+        if attempt + 1 >= self.attempts or not self.is_retryable(error):
+            return None
+        ceiling = min(self.max_backoff, self.backoff * 2 ** attempt)
+        suggested = self.suggested_wait(error)
+        if suggested is None:
+            wait = random.uniform(0, ceiling)
+        else:
+            wait = suggested + random.uniform(0, self.backoff)
+        if time.monotonic() - start + wait > self.deadline: return None
+        return wait
+
+
+
+class TokenBucket:
+    """A bucket which holds up to a minute's worth of some quantity, and
+    refills continuously at that rate. Amounts are taken out of it, and can be
+    given back if too much was taken. Its level can drop below zero, in which
+    case it must refill before anything else is taken.
+
+    :param float per_minute: The amount the bucket refills by each minute.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+    
+
+    def __repr__(self):
+        return f"TokenBucket({self.level:.0f}/{self.capacity})"
+    
+
+    def refill(self):
+        """Adds whatever has accumulated since the bucket was last updated."""
+
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.capacity / 60
+        )
+        self.updated = now
+    
+
+    def wait_time(self, amount):
+        """Gets the number of seconds until the amount given can be taken. An
+        amount larger than the bucket's capacity only has to wait for a full
+        bucket.
+
+        :param float amount: The amount to be taken.
+        :rtype: float
+        """
+
+        shortfall = min(amount, self.capacity) - self.level
+        return max(shortfall, 0) * 60 / self.capacity
+    
+
+    def take(self, amount):
+        """Removes an amount from the bucket.
+
+        :param float amount: The amount to take.
+        """
+
+        self.level -= amount
+    
+
+    def give(self, amount):
+        """Returns an amount to the bucket, up to its capacity.
+
+        :param float amount: The amount to give back.
+        """
+
+        self.level = min(self.capacity, self.level + amount)
+
+
+
+class RateLimiter:
+    """Paces requests so that they stay within an account's requests per minute
+    and tokens per minute quotas, rather than running into rate limit errors.
+
+    Before each request, its token usage is estimated and reserved, waiting if
+    there is not enough quota left. Once the actual usage is known the
+    difference is settled. A limiter can be shared between users of the same
+    account, and is safe to use from many threads.
+
+    :param int requests_per_minute: The requests allowed per minute.
+    :param int tokens_per_minute: The tokens allowed per minute.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"RateLimiter({self.requests}, {self.tokens})"
+    
+
+    def try_acquire(self, tokens):
+        """Reserves quota for one request using the given number of tokens if
+        it is available now. Otherwise nothing is reserved, and the number of
+        seconds to wait before trying again is returned.
+
+        :param int tokens: The estimated tokens the request will use.
+        :rtype: float
+        """
+
+        with self.lock:
+            buckets = [(b, n) for b, n in ((self.requests, 1), (self.tokens, tokens)) if b]
+            for bucket, _ in buckets: bucket.refill()
+            wait = max([bucket.wait_time(n) for bucket, n in buckets], default=0)
+            if wait: return wait
+            for bucket, amount in buckets: bucket.take(amount)
+            return 0
+    
+
+    def acquire(self, tokens, deadline=None, cancel=None):
+        """Reserves quota for one request using the given number of tokens,
+        blocking until it is available. If the deadline passes or the token is
+        cancelled first, nothing is reserved, and :py:class:`DeadlineError` or
+        :py:class:`Cancelled` is raised.
+
+        :param int tokens: The estimated tokens the request will use.
+        :param float deadline: The monotonic time to give up at, if any.
+        :param CancelToken cancel: A token for giving up.
+        """
+
+        while True:
+            if cancel: cancel.check()
+            wait = self.try_acquire(tokens)
+            if not wait: return
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineError("The request took longer than its total timeout")
+                wait = min(wait, remaining)
+            if cancel:
+                cancel.wait(wait)
+            else:
+                time.sleep(wait)
+    
+
+    async def acquire_async(self, tokens):
+        """Reserves quota for one request using the given number of tokens,
+        without blocking the event loop while waiting for it.
+
+        :param int tokens: The estimated tokens the request will use.
+        """
+
+        while wait := self.try_acquire(tokens): await asyncio.sleep(wait)
+    
+
+    def settle(self, estimated, actual):
+        """Corrects the tokens reserved for a request once the number it
+        actually used is known.
+
+        :param int estimated: The tokens that were reserved.
+        :param int actual: The tokens that were used.
+        """
+
+        if not self.tokens: return
+        with self.lock:
+            self.tokens.refill()
+            if actual > estimated:
+                self.tokens.take(actual - estimated)
+            else:
+                self.tokens.give(estimated - actual)
+
+
+
+class KeyQuota:
+    """What is known about how much of an API key's quota is left, from the
+    rate limit headers of the API's most recent response to it. Until a
+    response reports otherwise, or once the reported quota has reset, a key is
+    assumed to have plenty left. Requests sent since the last report are
+    taken off it, so that keys are not chosen over and over in the meantime.
+
+    A key can also be benched for a while after running into its rate limit,
+    during which time it should not be chosen.
+    """
+
+    def __init__(self):
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.reset_at = 0
+        self.benched_until = 0
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"KeyQuota({self.remaining_requests} requests, {self.remaining_tokens} tokens)"
+    
+
+    def observe(self, headers):
+        """Takes the remaining quota from the headers of a response.
+
+        :param dict headers: The response's headers.
+        """
+
+        headers = {k.lower(): v for k, v in headers.items()}
+        if "x-ratelimit-remaining-tokens" not in headers: return
+        resets = [
+            parse_duration(headers[f"x-ratelimit-reset-{kind}"])
+            for kind in ("requests", "tokens") if f"x-ratelimit-reset-{kind}" in headers
+        ]
+        with self.lock:
+            self.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            requests = headers.get("x-ratelimit-remaining-requests")
+            self.remaining_requests = int(requests) if requests else None
+            self.reset_at = time.monotonic() + max(resets, default=60)
+    
+
+    def reserve(self, tokens):
+        """Takes a request's estimated tokens off the remaining quota.
+
+        :param int tokens: The estimated tokens the request will use.
+        """
+
+        with self.lock:
+            if self.remaining_tokens is not None: self.remaining_tokens -= tokens
+            if self.remaining_requests is not None: self.remaining_requests -= 1
+    
+
+    def bench(self, seconds):
+        """Takes the key out of rotation for a number of seconds.
+
+        :param float seconds: How long to bench the key for.
+        """
+
+        self.benched_until = max(self.benched_until, time.monotonic() + seconds)
+    
+
+    @property
+    def benched(self):
+        """Whether the key is currently out of rotation.
+
+        :rtype: bool
+        """
+
+        return time.monotonic() < self.benched_until
+    
+
+    @property
+    def headroom(self):
+        """How many tokens of the key's quota are left - none if it has no
+        requests left, and infinitely many if nothing is known or the quota
+        has reset.
+
+        :rtype: float
+        """
+
+        if self.remaining_tokens is None or time.monotonic() >= self.reset_at:
+            return float("inf")
+        return 0 if self.remaining_requests == 0 else self.remaining_tokens
+
+
+
+class Endpoint:
+    """A base URL that API requests can be sent to, with a record of how
+    quickly it has been responding and whether it is currently down.
+
+    :param str url: The base URL, which paths are added to.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/") + "/"
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0
+    
+
+    def __repr__(self):
+        latency = "?" if self.latency is None else f"{self.latency * 1000:.0f}ms"
+        return f"Endpoint({self.url}, {latency})"
+    
+
+    @property
+    def healthy(self):
+        """Whether the endpoint is currently thought to be up.
+
+        :rtype: bool
+        """
+
+        return time.monotonic() >= self.down_until
+
+
+
+class Router:
+    """Sends requests to whichever of several endpoints serving the same API
+    is fastest - such as regional endpoints, a proxy, or a number of local
+    inference servers. Each endpoint's latency is tracked as a moving average
+    of how long it takes to respond, and endpoints which haven't been tried
+    yet are tried first.
+
+    An endpoint which can't be reached, or responds with a server error, is
+    taken out of rotation for ``cooldown`` seconds (doubling with each failure
+    in a row, up to ``max_cooldown``), and the request is sent to the next
+    fastest straight away.
+
+    :param list urls: The base URLs of the endpoints.
+    :param float cooldown: How long to take a failing endpoint out for.
+    :param float smoothing: How much weight each new latency has in the average.
+    :param float max_cooldown: The longest an endpoint is taken out for.
+    """
+
+    def __init__(self, urls, cooldown=30, smoothing=0.2, max_cooldown=300):
+        if isinstance(urls, str): urls = [urls]
+        if not urls: raise ValueError("A router needs at least one endpoint")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"Router({', '.join(endpoint.url for endpoint in self.endpoints)})"
+    
+
+    def choose(self, exclude=()):
+        """Picks the fastest healthy endpoint - or if none are healthy, the one
+        back in rotation soonest.
+
+        :param exclude: Endpoints not to pick.
+        :rtype: Endpoint
+        """
+
+        endpoints = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        healthy = [endpoint for endpoint in endpoints if endpoint.healthy]
+        if not healthy: return min(endpoints, key=lambda endpoint: endpoint.down_until)
+        return min(healthy, key=lambda endpoint: endpoint.latency or 0)
+    
+
+    def succeed(self, endpoint, seconds):
+        """Records that an endpoint responded, and how long it took.
+
+        :param Endpoint endpoint: The endpoint.
+        :param float seconds: How long it took to respond.
+        """
+
+        with self.lock:
+            endpoint.failures = 0
+            if endpoint.latency is None:
+                endpoint.latency = seconds
+            else:
+                endpoint.latency += self.smoothing * (seconds - endpoint.latency)
+    
+
+    def fail(self, endpoint):
+        """Records that an endpoint failed, taking it out of rotation.
+
+        :param Endpoint endpoint: The endpoint.
+        """
+
+        with self.lock:
+            cooldown = min(self.cooldown * 2 ** min(endpoint.failures, 10), self.max_cooldown)
+            endpoint.down_until = time.monotonic() + cooldown
+            endpoint.failures += 1
+
+
+
+class Hedging:
+    """Cuts the tail latency of chat completions by hedging slow requests. If
+    a completion hasn't come back (or started streaming) by the time most
+    recent ones have, the same request is sent again, and whichever answers
+    first is used. The other is cancelled, or its response discarded.
+
+    The delay before hedging is a percentile of the latencies of recent
+    completions, so it adapts as the API speeds up and slows down. Nothing is
+    hedged until enough latencies have been seen. As each hedge costs as much
+    as the request it duplicates, the fraction of requests which can be hedged
+    is capped by a budget.
+
+    :param float percentile: The percentile of recent latencies to hedge at.
+    :param float budget: The most hedges to send, as a fraction of requests.
+    :param int window: How many recent latencies to keep.
+    :param int min_samples: How many latencies to see before hedging.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, window=200, min_samples=20):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"Hedging({self.hedges} hedges, {self.wins} wins, {self.requests} requests)"
+    
+
+    def delay(self):
+        """Gets the number of seconds to wait before hedging a request, or
+        ``None`` if too few latencies have been seen yet to hedge.
+
+        :rtype: float
+        """
+
+        with self.lock:
+            if len(self.latencies) < self.min_samples: return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)]
+    
+
+    def allow(self):
+        """Checks whether the budget allows another hedge, and if so counts
+        one.
+
+        :rtype: bool
+        """
+
+        with self.lock:
+            if self.hedges >= self.budget * self.requests: return False
+            self.hedges += 1
+            return True
+    
+
+    def record(self, seconds, won=False):
+        """Records how long a request took to be answered, and whether it was
+        answered by a hedge.
+
+        :param float seconds: How long the request took.
+        :param bool won: Whether a hedge answered first.
+        """
+
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            if won: self.wins += 1
+    
+
+    @property
+    def hedge_rate(self):
+        """The fraction of requests which have been hedged.
+
+        :rtype: float
+        """
+
+        return self.hedges / self.requests if self.requests else 0
+    
+
+    @property
+    def win_rate(self):
+        """The fraction of hedges which answered before the original request.
+
+        :rtype: float
+        """
+
+        return self.wins / self.hedges if self.hedges else 0
+
+
+
+class SingleFlight:
+    """Coalesces identical calls which are in progress at the same time, so
+    that only the first is actually made, and the rest wait for and share its
+    result (or its exception). Once a call finishes, the next identical one
+    is made afresh.
+
+    Each caller waits with its own deadline and cancel token, and if the call
+    being waited for is abandoned by its own caller, the call is made again
+    rather than that being passed on. Calls in threads and calls on an event
+    loop are coalesced separately.
+    """
+
+    def __init__(self):
+        self.futures = {}
+        self.tasks = {}
+        self.shared = 0
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"SingleFlight({len(self.futures) + len(self.tasks)} in flight, {self.shared} shared)"
+    
+
+    def run(self, key, function, deadline=None, cancel=None):
+        """Calls a function, unless a call with the same key is already in
+        progress, in which case its result is waited for and returned. The
+        function is expected to keep to the deadline and token itself.
+
+        :param str key: What identifies identical calls.
+        :param function: The function to call.
+        :param float deadline: The monotonic time to stop waiting at, if any.
+        :param CancelToken cancel: A token for giving up waiting.
+        """
+
+        while True:
+            with self.lock:
+                future = self.futures.get(key)
+                if future is None:
+                    future = self.futures[key] = Future()
+                    break
+                self.shared += 1
+            wait_for_future(future, deadline, cancel)
+            if not isinstance(future.exception(), (Cancelled, DeadlineError)):
+                return future.result()
+        try:
+            result = function()
+        except BaseException as e:
+            with self.lock: del self.futures[key]
+            future.set_exception(e)
+            raise
+        with self.lock: del self.futures[key]
+        future.set_result(result)
+        return result
+    
+
+    async def run_async(self, key, function):
+        """Awaits a coroutine function, unless a call with the same key is
+        already in progress, in which case its result is awaited instead. A
+        caller which is cancelled doesn't cancel the call for the others,
+        unless there are no others waiting for it.
+
+        :param str key: What identifies identical calls.
+        :param function: The coroutine function to call.
+        """
+
+        while True:
+            entry = self.tasks.get(key)
+            leader = entry is None
+            if leader:
+                entry = self.tasks[key] = [asyncio.ensure_future(function()), 0]
+                entry[0].add_done_callback(lambda _, entry=entry: self.finish(key, entry))
+            else:
+                self.shared += 1
+            task = entry[0]
+            entry[1] += 1
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.done() and entry[1] == 1: task.cancel()
+                if leader or not task.cancelled(): raise
+            except asyncio.TimeoutError as e:
+                if leader or isinstance(e, aiohttp.ServerTimeoutError): raise
+            finally:
+                entry[1] -= 1
+            self.finish(key, entry)
+    
+
+    def finish(self, key, entry):
+        """Forgets a finished call on an event loop, if it is still the one
+        in progress for its key.
+
+        :param str key: What identifies identical calls.
+        :param list entry: The call's task and how many are waiting for it.
+        """
+
+        if self.tasks.get(key) is entry: del self.tasks[key]
+
+
+
+class CompletionCache:
+    """A cache of chat completions, so that sending exactly the same request
+    twice only costs one round trip. Requests are identified by a hash of their
+    model, messages and parameters.
+
+    Recently used completions are kept in memory, up to a maximum number. If a
+    path is given, every completion is also saved to an SQLite database there,
+    which outlives the process and is checked when the memory tier misses.
+
+    :param int maxsize: The most completions to keep in memory.
+    :param str path: The path of the database file, if any.
+    """
+
+    def __init__(self, maxsize=1024, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, data TEXT)"
+            )
+            self.db.commit()
+    
+
+    def __repr__(self):
+        return f"CompletionCache({self.hits} hits, {self.misses} misses)"
+    
+
+    def __len__(self):
+        return len(self.memory)
+    
+
+    @staticmethod
+    def key(body):
+        """Gets the key a request body is cached under. Bodies which differ
+        only in the order of their keys get the same key.
+
+        :param dict body: The request body.
+        :rtype: str
+        """
+
+        canonical = json.dumps(
+            body, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+    
+
+    @property
+    def hit_rate(self):
+        """The proportion of lookups which were found in the cache.
+
+        :rtype: float
+        """
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+    
+
+    def get(self, key):
+        """Looks up the completion data cached under a key, returning ``None``
+        if there isn't any.
+
+        :param str key: The key to look up.
+        :rtype: dict or bytes
+        """
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            if self.db:
+                row = self.db.execute(
+                    "SELECT data FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    self.hits += 1
+                    data = row[0] if isinstance(row[0], bytes) else loads(row[0])
+                    self.remember(key, data)
+                    return data
+            self.misses += 1
+            return None
+    
+
+    def put(self, key, data):
+        """Caches the completion data for a key. Raw response bodies are cached
+        as they are, without being decoded.
+
+        :param str key: The key to cache it under.
+        :param data: The JSON data from the API, decoded or raw.
+        """
+
+        with self.lock:
+            self.remember(key, data)
+            if self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO completions VALUES (?, ?)",
+                    (key, data if isinstance(data, bytes) else json.dumps(data))
+                )
+                self.db.commit()
+    
+
+    def remember(self, key, data):
+        """Puts completion data in the memory tier, evicting the least recently
+        used if it is full.
+
+        :param str key: The key to cache it under.
+        :param dict data: The JSON data from the API.
+        """
+
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+    
+
+    def clear(self):
+        """Removes everything from the cache, including the database."""
+
+        with self.lock:
+            self.memory.clear()
+            if self.db:
+                self.db.execute("DELETE FROM completions")
+                self.db.commit()
+
+
+
+class HashingEmbedder:
+    """Turns text into a vector locally, without a model, by hashing its words
+    and the pairs of words in it into a fixed number of dimensions. Texts which
+    share much of their wording get similar vectors. This is deterministic, so
+    the same text always gets the same vector, in any process.
+
+    Any callable which takes a string and returns a vector can be used as an
+    embedder instead, such as an :py:class:`OpenAIEmbedder`.
+
+    :param int dimensions: The length of the vectors.
+    """
+
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+    
+
+    def __repr__(self):
+        return f"HashingEmbedder({self.dimensions})"
+    
+
+    def __call__(self, text):
+        vector = numpy.zeros(self.dimensions, dtype=numpy.float32)
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[index] += 1 if digest[4] & 1 else -1
+        return vector
+
+
+
+class OpenAIEmbedder:
+    """Turns text into a vector using one of OpenAI's embedding models.
+
+    :param User user: The user to make requests as.
+    :param str model: The ID of the embedding model.
+    """
+
+    def __init__(self, user, model="text-embedding-3-small"):
+        self.user = user
+        self.model = model
+    
+
+    def __repr__(self):
+        return f"OpenAIEmbedder({self.model})"
+    
+
+    def __call__(self, text):
+        data = self.user.post("embeddings", json={"model": self.model, "input": text})
+        return numpy.array(data["data"][0]["embedding"], dtype=numpy.float32)
+
+
+
+class SemanticIndex:
+    """A fixed-size store of unit vectors, each with a response attached, which
+    can be searched for the vector most similar to a query. When full, the
+    least recently used entry is replaced.
+
+    :param int dimensions: The length of the vectors.
+    :param int maxsize: The most entries to hold.
+    """
+
+    def __init__(self, dimensions, maxsize):
+        self.maxsize = maxsize
+        self.vectors = numpy.zeros((min(maxsize, 64), dimensions), dtype=numpy.float32)
+        self.used = numpy.zeros(len(self.vectors), dtype=numpy.float64)
+        self.responses = []
+    
+
+    def __repr__(self):
+        return f"SemanticIndex({len(self)}/{self.maxsize})"
+    
+
+    def __len__(self):
+        return len(self.responses)
+    
+
+    def search(self, vector):
+        """Finds the entry most similar to a unit vector, returning its index
+        and cosine similarity, or ``(None, 0)`` if the index is empty.
+
+        :param numpy.ndarray vector: The vector to search for.
+        :rtype: tuple
+        """
+
+        if not self.responses: return None, 0
+        similarities = self.vectors[:len(self)] @ vector
+        index = int(numpy.argmax(similarities))
+        self.used[index] = time.monotonic()
+        return index, float(similarities[index])
+    
+
+    def add(self, vector, response):
+        """Adds a unit vector and its response to the index.
+
+        :param numpy.ndarray vector: The vector to add.
+        :param Response response: The response to return for it.
+        """
+
+        if len(self) < self.maxsize:
+            index = len(self)
+            if index == len(self.vectors):
+                size = min(self.maxsize, len(self.vectors) * 2)
+                self.vectors = numpy.resize(self.vectors, (size, self.vectors.shape[1]))
+                self.used = numpy.resize(self.used, size)
+            self.responses.append(response)
+        else:
+            index = int(numpy.argmin(self.used))
+            self.responses[index] = response
+        self.vectors[index] = vector
+        self.used[index] = time.monotonic()
+
+
+
+class SemanticCache:
+    """A cache of replies to the opening messages of conversations, which
+    matches messages by meaning rather than exact wording - so that paraphrases
+    of a message already answered can reuse its reply. This requires numpy.
+
+    Messages are embedded as vectors, and each agent (model, parameters and
+    prompt) has its own index of vectors. If the most similar message in the
+    index is at least as similar as the threshold, its reply is returned.
+
+    :param embedder: The callable which turns text into vectors.
+    :param float threshold: The cosine similarity needed to count as a match.
+    :param int maxsize: The most messages to hold for each agent.
+    """
+
+    def __init__(self, embedder=None, threshold=0.9, maxsize=1000):
+        if numpy is None:
+            raise ImportError("SemanticCache requires numpy to be installed")
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.indexes = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"SemanticCache({self.hits} hits, {self.misses} misses)"
+    
+
+    @staticmethod
+    def scope(agent):
+        """Gets the key of the index an agent's messages are kept in.
+
+        :param Agent agent: The agent.
+        :rtype: str
+        """
+
+        return CompletionCache.key({
+            "model": agent.model, **agent.parameters, "prompt": agent.prompt.content
+        })
+    
+
+    def embed(self, text):
+        """Embeds text as a unit vector.
+
+        :param str text: The text to embed.
+        :rtype: numpy.ndarray
+        """
+
+        vector = numpy.asarray(self.embedder(text), dtype=numpy.float32)
+        norm = numpy.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+
+    def get(self, agent, message, vector=None):
+        """Looks up the reply to a message similar enough to the one given,
+        returning ``None`` if there isn't one. The message's vector can be
+        given if it has already been embedded, so that it isn't again.
+
+        :param Agent agent: The agent the message is to.
+        :param str message: The message to look up.
+        :param numpy.ndarray vector: The message embedded with :py:meth:`embed`.
+        :rtype: Response
+        """
+
+        if vector is None: vector = self.embed(message)
+        with self.lock:
+            index = self.indexes.get(self.scope(agent))
+            position, similarity = index.search(vector) if index else (None, 0)
+            if position is not None and similarity >= self.threshold:
+                self.hits += 1
+                return index.responses[position]
+            self.misses += 1
+            return None
+    
+
+    def put(self, agent, message, response, vector=None):
+        """Caches the reply to a message. The message's vector can be given if
+        it has already been embedded - when it was looked up, say.
+
+        :param Agent agent: The agent the message was to.
+        :param str message: The message.
+        :param Response response: The agent's reply.
+        :param numpy.ndarray vector: The message embedded with :py:meth:`embed`.
+        """
+
+        if vector is None: vector = self.embed(message)
+        with self.lock:
+            scope = self.scope(agent)
+            if scope not in self.indexes:
+                self.indexes[scope] = SemanticIndex(len(vector), self.maxsize)
+            self.indexes[scope].add(vector, response)
+    
+
+    def save(self, path):
+        """Saves the cache's indexes to a numpy ``.npz`` file. The vectors of
+        each index are stored as an array, and the responses as JSON. The
+        ``.npz`` suffix is added to the path if it doesn't have it.
+
+        :param str path: The path to save to.
+        """
+
+        if not str(path).endswith(".npz"): path = f"{path}.npz"
+
+        arrays = {}
+        with self.lock:
+            for i, (scope, index) in enumerate(self.indexes.items()):
+                arrays[f"vectors_{i}"] = index.vectors[:len(index)]
+                arrays[f"responses_{i}"] = numpy.array(json.dumps({
+                    "scope": scope,
+                    "responses": [response.to_dict() for response in index.responses]
+                }))
+        numpy.savez_compressed(path, **arrays)
+    
+
+    def load(self, path):
+        """Loads indexes saved with :py:meth:`save` into the cache. They should
+        have been made with the same embedder. As with :py:meth:`save`, the
+        ``.npz`` suffix is added to the path if it doesn't have it.
+
+        :param str path: The path to load from.
+        """
+
+        if not str(path).endswith(".npz"): path = f"{path}.npz"
+
+        with numpy.load(path) as arrays, self.lock:
+            for name in arrays.files:
+                if not name.startswith("vectors_"): continue
+                vectors = arrays[name]
+                saved = json.loads(str(arrays[name.replace("vectors", "responses")]))
+                index = SemanticIndex(vectors.shape[1], self.maxsize)
+                for vector, data in zip(vectors, saved["responses"]):
+                    index.add(vector, Response(data))
+                self.indexes[saved["scope"]] = index
+
+
+
+class ModelCatalogue:
+    """The models available with an API key, along with metadata about them.
+
+    The list of models is fetched from the API the first time it is needed,
+    and then kept for a time-to-live. After that it is refreshed in the
+    background, while the old list continues to be used. Users with the same
+    key and settings share a catalogue.
+
+    Metadata comes from the bundled ``MODEL_METADATA`` table, and can be
+    overridden or added to for particular models, so that things like context
+    windows are known without asking the API.
+
+    :param float ttl: How many seconds the list of models is fresh for.
+    :param dict metadata: Metadata to use instead of the bundled table's.
+    """
+
+    catalogues = {}
+
+    def __init__(self, ttl=3600, metadata=None):
+        self.ttl = ttl
+        self.metadata = dict(metadata or {})
+        self.ids = None
+        self.fetched = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        count = "?" if self.ids is None else len(self.ids)
+        return f"ModelCatalogue({count} models)"
+    
+
+    def __contains__(self, model):
+        return self.ids is not None and model in self.ids
+    
+
+    @classmethod
+    def for_key(cls, openai_key, router=None, ttl=3600, metadata=None):
+        """Gets the catalogue for an API key, creating it if there isn't one.
+        Different servers offer different models, so the same key has a
+        separate catalogue for each set of endpoints it is used with - and
+        for each time-to-live and set of metadata overrides.
+
+        :param str openai_key: The API key.
+        :param Router router: The endpoints the key is used with.
+        :param float ttl: How many seconds the list of models is fresh for.
+        :param dict metadata: Metadata to use instead of the bundled table's.
+        :rtype: ModelCatalogue
+        """
+
+        urls = tuple(endpoint.url for endpoint in router.endpoints) if router else (BASE_URL,)
+        key = (openai_key, urls, ttl, json.dumps(metadata or {}, sort_keys=True))
+        return cls.catalogues.setdefault(key, cls(ttl, metadata))
+    
+
+    @property
+    def stale(self):
+        """Whether the list of models is older than its time-to-live.
+
+        :rtype: bool
+        """
+
+        return self.ids is None or time.monotonic() - self.fetched > self.ttl
+    
+
+    def update(self, data):
+        """Replaces the list of models with the API's latest.
+
+        :param dict data: The JSON data from the API's models endpoint.
+        """
+
+        self.ids = [model["id"] for model in data["data"]]
+        self.fetched = time.monotonic()
+    
+
+    def start_refresh(self):
+        """Marks the catalogue as being refreshed, if it is stale and not being
+        refreshed already. Whoever gets ``True`` back should do the refresh and
+        then call :py:meth:`finish_refresh`.
+
+        :rtype: bool
+        """
+
+        with self.lock:
+            if not self.stale or self.refreshing: return False
+            self.refreshing = True
+            return True
+    
+
+    def finish_refresh(self):
+        """Marks the catalogue as no longer being refreshed."""
+
+        self.refreshing = False
+    
+
+    def info(self, model):
+        """Gets the metadata of a model, with any overrides applied.
+
+        :param str model: The ID of the model.
+        :rtype: dict
+        """
+
+        return {
+            "id": model,
+            **model_metadata(model),
+            **model_metadata(model, self.metadata)
+        }
+
+
+
+class SQLiteStore:
+    """Persists conversations to an SQLite database, so that they outlive the
+    process and can be picked up by other workers.
+
+    Only messages which haven't been saved yet are written, so saving after
+    each turn just appends that turn's rows. Writes are committed in batches,
+    once a number of rows are waiting or when :py:meth:`flush` is called, and
+    the database uses write-ahead logging so that this is cheap. Messages
+    should only be appended to a saved conversation, not removed or changed.
+
+    :param str path: The path of the database file.
+    :param int batch_size: The rows to write before committing.
+    """
+
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY, model TEXT, prompt TEXT, parameters TEXT
+            );
+            CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, data TEXT);
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation_id TEXT, position INTEGER, role TEXT, content TEXT,
+                response_id TEXT, pinned INTEGER,
+                PRIMARY KEY (conversation_id, position)
+            );
+        """)
+        self.db.commit()
+    
+
+    def __repr__(self):
+        return f"SQLiteStore({self.path})"
+    
+
+    def save(self, conversation):
+        """Writes whatever the store doesn't have yet of a conversation.
+
+        :param Conversation conversation: The conversation to save.
+        """
+
+        with self.lock:
+            start = conversation.stored
+            if start == 0:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO conversations VALUES (?, ?, ?, ?)", (
+                        conversation.id, conversation.agent.model,
+                        conversation.agent.prompt.content,
+                        json.dumps(conversation.agent.parameters)
+                    )
+                )
+            messages = conversation.messages[start:]
+            self.db.executemany("INSERT OR IGNORE INTO responses VALUES (?, ?)", [
+                (message.response.id, json.dumps(message.response.to_dict()))
+                for message in messages if message.response
+            ])
+            self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", [(
+                conversation.id, position, message.role, message.content,
+                message.response.id if message.response else None, message.pinned
+            ) for position, message in enumerate(messages, start=start)])
+            conversation.stored = start + len(messages)
+            self.pending += len(messages) + 1
+            if self.pending >= self.batch_size: self.commit()
+    
+
+    def commit(self):
+        """Commits waiting writes. The store's lock should be held."""
+
+        self.db.commit()
+        self.pending = 0
+    
+
+    def flush(self):
+        """Commits any writes that are waiting."""
+
+        with self.lock:
+            self.commit()
+    
+
+    def close(self):
+        """Commits any writes that are waiting and closes the database."""
+
+        self.flush()
+        self.db.close()
+    
+
+    def ids(self):
+        """Lists the IDs of the conversations in the store.
+
+        :rtype: list
+        """
+
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM conversations")]
+    
+
+    def load(self, conversation_id, user, cls=None):
+        """Loads a conversation from the store. It will be saved back to the
+        store as it continues.
+
+        :param str conversation_id: The ID of the conversation.
+        :param User user: The user to continue the conversation as.
+        :param type cls: The conversation class (by default chosen by the user's type).
+        :raises KeyError: if there is no conversation with the ID given.
+        :rtype: Conversation
+        """
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT model, prompt, parameters FROM conversations WHERE id = ?",
+                (conversation_id,)
+            ).fetchone()
+            if row is None: raise KeyError(conversation_id)
+            rows = self.db.execute(
+                "SELECT role, content, pinned, data FROM messages LEFT JOIN responses"
+                " ON responses.id = messages.response_id"
+                " WHERE conversation_id = ? ORDER BY position", (conversation_id,)
+            ).fetchall()
+        agent = Agent(row[0], row[1], **json.loads(row[2]))
+        messages = [Message(
+            role, content, Response(data, user.codec) if data else None, bool(pinned)
+        ) for role, content, pinned, data in rows]
+        if messages and messages[0].role == "system": agent.prompt = messages[0]
+        if cls is None:
+            cls = AsyncConversation if isinstance(user, AsyncUser) else Conversation
+        conversation = cls(user, agent, messages, store=self, id=conversation_id)
+        conversation.stored = len(messages)
+        return conversation
+
+
+
+def dump_jsonl(conversations, window=1000):
+    """Serialises conversations as JSON Lines, yielding one line (with its
+    newline) per conversation. Conversations are only taken from the iterable
+    as they are needed, so any number can be serialised in constant memory.
+
+    A fork whose parent came shortly before it only has the messages it added
+    itself written, so the messages they share are written once. The IDs of
+    the most recently written or used conversations which have been forked
+    are remembered to make this work, up to the window - a fork whose parent
+    is further back is written in full. :py:func:`import_jsonl` must be given
+    the same window.
+
+    :param conversations: An iterable of conversations.
+    :param int window: How many forked conversations to remember.
+    :rtype: Generator[str]
+    """
+
+    parents = OrderedDict()
+    for conversation in conversations:
+        parent = conversation.parent
+        shared = parent is not None and parent.id in parents
+        if shared: parents.move_to_end(parent.id)
+        yield json.dumps(conversation.to_json(shared=shared), ensure_ascii=False) + "\n"
+        if conversation.forked:
+            parents[conversation.id] = True
+            if len(parents) > window: parents.popitem(last=False)
+
+
+def export_jsonl(conversations, file, window=1000):
+    """Writes conversations to a JSON Lines file, one per line, and returns the
+    number written. Conversations are only taken from the iterable as they are
+    written, so it can be a generator over far more than fit in memory.
+
+    :param conversations: An iterable of conversations.
+    :param file: A path, or a text file opened for writing.
+    :param int window: How many forked conversations to remember.
+    :rtype: int
+    """
+
+    if isinstance(file, str):
+        with open(file, "w", encoding="utf-8") as f:
+            return export_jsonl(conversations, f, window)
+    count = 0
+    for line in dump_jsonl(conversations, window):
+        file.write(line)
+        count += 1
+    return count
+
+
+def import_jsonl(file, user, window=1000):
+    """Reads conversations from a JSON Lines file, yielding them one at a time
+    as each line is read, so a file of any size can be read in constant memory.
+    The most recent conversations which have been forked are kept, up to the
+    window the file was exported with, so that their forks can share their
+    messages.
+
+    :param file: A path, or a text file opened for reading.
+    :param User user: The user to continue the conversations as.
+    :param int window: How many forked conversations to keep.
+    :rtype: Generator[Conversation]
+    """
+
+    if isinstance(file, str):
+        with open(file, encoding="utf-8") as f:
+            yield from import_jsonl(f, user, window)
+        return
+    cls = AsyncConversation if isinstance(user, AsyncUser) else Conversation
+    parents = OrderedDict()
+    for line in file:
+        if not line.strip(): continue
+        data = json.loads(line)
+        parent = parents.get(data.get("parent"))
+        if parent is not None: parents.move_to_end(parent.id)
+        conversation = cls.from_json(data, user, parent)
+        if conversation.forked:
+            parents[conversation.id] = conversation
+            if len(parents) > window: parents.popitem(last=False)
+        yield conversation
+
+
 
 class User:
     """A user of the OpenAI API, with a token and an account.
+
+    Requests are made over a persistent session, so connections to the API are
+    reused. By default each user gets its own session, but one can be passed in
+    to share a connection pool between many users. The quota the API reports
+    is left for the user's key is kept in :py:attr:`quota`.
+
+    Requests go to OpenAI by default, but can be sent to any server with the
+    same API by giving its base URL, or to several with a :py:class:`Router`.
+
+    Every request has a :py:class:`Timeout`, which can be overridden for a
+    single call, as can any keyword argument of :py:meth:`request`. Calls can
+    also be given a :py:class:`CancelToken` to abandon them from elsewhere.
+    
+    :param str openai_key: The API key for the user.
+    :param requests.Session session: The HTTP session to make requests with.
+    :param int pool_size: The connections per host if a session is created.
+    :param RateLimiter rate_limiter: Paces requests to stay within quotas.
+    :param RetryPolicy retry: How to retry failed requests (``None`` to not).
+    :param CompletionCache cache: Where to cache chat completions, if anywhere.
+    :param SemanticCache semantic_cache: Where to cache replies to openers.
+    :param SQLiteStore store: Where to save conversations the user starts.
+    :param JSONCodec codec: The JSON codec to use (by default the fastest).
+    :param base_url: The API's base URL, or a :py:class:`Router`.
+    :param Hedging hedging: How to hedge slow chat completions, if at all.
+    :param bool coalesce: Whether to share identical concurrent completions.
+    :param Timeout timeout: How long requests can take.
+    :param float catalogue_ttl: How many seconds the list of models is fresh for.
+    :param dict catalogue_metadata: Model metadata to use instead of the bundled table's.
+    """
+
+    def __init__(
+        self, openai_key, session=None, pool_size=10, rate_limiter=None,
+        retry=DEFAULT, cache=None, semantic_cache=None, store=None, codec=None,
+        base_url=BASE_URL, hedging=None, coalesce=False, timeout=None,
+        catalogue_ttl=3600, catalogue_metadata=None
+    ):
+        self.openai_key = openai_key
+        self.pool_size = pool_size
+        self.session = session or self.new_session()
+        self.rate_limiter = rate_limiter
+        self.retry = RetryPolicy() if retry is DEFAULT else retry
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+        self.store = store
+        self.codec = codec or CODEC
+        self.router = base_url if isinstance(base_url, Router) else Router(base_url)
+        self.catalogue = ModelCatalogue.for_key(
+            openai_key, self.router, catalogue_ttl, catalogue_metadata
+        )
+        self.quota = KeyQuota()
+        self.hedging = hedging
+        self.flights = SingleFlight() if coalesce else None
+        self.timeout = Timeout.of(timeout) or Timeout()
+    
+
+    def __repr__(self):
+        truncated_key = self.openai_key[:13] + "..." + self.openai_key[-5:]
+        return f"{type(self).__name__}({truncated_key})"
+    
+
+    def new_session(self):
+        """Creates an HTTP session for the user, with its own connection pool.
+
+        :rtype: requests.Session
+        """
+
+        return create_session(self.pool_size)
+    
+
+    @property
+    def headers(self):
+        """The HTTP headers sent with every request to the API.
+
+        :rtype: dict
+        """
+
+        return {
+            "Authorization": f"Bearer {self.openai_key}",
+            "Content-Type": "application/json",
+        }
+    
+
+    def encode(self, kwargs):
+        """Encodes the ``json`` argument of a request with the user's codec,
+        returning the arguments with it replaced by the encoded ``data``.
+
+        :param dict kwargs: The request's keyword arguments.
+        :rtype: dict
+        """
+
+        if "json" not in kwargs: return kwargs
+        kwargs = dict(kwargs)
+        kwargs["data"] = self.codec.dumps(kwargs.pop("json"))
+        return kwargs
+
+
+    def send(self, method, path, estimate=0, **kwargs):
+        """Makes a single attempt at an authorized request to the OpenAI API,
+        and returns the HTTP response. An :py:class:`APIError` is raised if
+        the API responds with an error status.
+
+        The request goes to the user's fastest healthy endpoint. If that can't
+        be reached or has a server error, it is sent to the next, until every
+        endpoint has been tried.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :rtype: requests.Response
+        """
+
+        self.quota.reserve(estimate)
+        tried = []
+        while True:
+            endpoint = self.router.choose(exclude=tried)
+            tried.append(endpoint)
+            last = len(tried) >= len(self.router.endpoints)
+            start = time.monotonic()
+            try:
+                response = self.session.request(
+                    method, endpoint.url + path, headers=self.headers, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self.router.fail(endpoint)
+                if last: raise
+                continue
+            if response.status_code < 500:
+                self.router.succeed(endpoint, time.monotonic() - start)
+            else:
+                self.router.fail(endpoint)
+                if not last:
+                    response.close()
+                    continue
+            break
+        self.quota.observe(response.headers)
+        if response.status_code >= 400:
+            error = APIError.from_body(
+                response.status_code, response.content, response.headers
+            )
+            response.close()
+            raise error
+        return response
+    
+
+    def send_with_retries(self, method, path, estimate=0, deadline=None, cancel=None, **kwargs):
+        """Sends an authorized request to the OpenAI API, retrying it according
+        to the user's retry policy if it fails, and returns the HTTP response.
+        No attempt is started once the deadline has passed or the token has
+        been cancelled, and waits between attempts end early if either happens.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :param float deadline: The monotonic time to give up at, if any.
+        :param CancelToken cancel: A token for giving up.
+        :rtype: requests.Response
+        """
+
+        start, attempt = time.monotonic(), 0
+        while True:
+            if cancel: cancel.check()
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineError("The request took longer than its total timeout")
+            try:
+                return self.send(method, path, estimate, **kwargs)
+            except Exception as e:
+                wait = self.retry.wait(e, attempt, start) if self.retry else None
+                if wait is None: raise
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0: raise
+                if cancel:
+                    cancel.wait(wait)
+                else:
+                    time.sleep(wait)
+                attempt += 1
+    
+
+    def send_hedged(self, method, path, estimate=0, deadline=None, cancel=None, **kwargs):
+        """Sends an authorized request to the OpenAI API with retries, hedging
+        it if the user hedges chat completions and it is one, and returns the
+        HTTP response. Each attempt has its own cancel token, which is
+        cancelled once the race is over, so that an attempt which loses makes
+        no further retries - its request in progress carries on in the
+        background, and its response is closed when it arrives.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :param float deadline: The monotonic time to give up at, if any.
+        :param CancelToken cancel: A token for giving up.
+        :rtype: requests.Response
+        """
+
+        hedging = self.hedging
+        if hedging is None or path != "chat/completions":
+            return self.send_with_retries(method, path, estimate, deadline, cancel, **kwargs)
+        start = time.monotonic()
+        attempts, tokens = [], []
+        def attempt():
+            token = CancelToken()
+            if cancel: cancel.on_cancel(token.cancel)
+            tokens.append(token)
+            attempts.append(run_in_thread(
+                self.send_with_retries, method, path, estimate, deadline, token, **kwargs
+            ))
+        winner, error = None, None
+        try:
+            attempt()
+            done, _ = wait(attempts, timeout=hedging.delay())
+            if not done and hedging.allow(): attempt()
+            for future in as_completed(attempts):
+                if future.exception() is None:
+                    winner = future
+                    break
+                error = error or future.exception()
+        finally:
+            for token in tokens:
+                if cancel: cancel.remove(token.cancel)
+                token.cancel()
+        for future in attempts:
+            if future is not winner: future.add_done_callback(discard_response)
+        if winner is None: raise error
+        hedging.record(time.monotonic() - start, won=winner is not attempts[0])
+        return winner.result()
+    
+
+    def request(self, method, path, raw=False, timeout=None, cancel=None, **kwargs):
+        """Make an authorized request to the OpenAI API. Returns whatever JSON
+        data the API responds with - or the raw body, without decoding it, if
+        requested. Transient failures are retried, and an
+        :py:class:`APIError` is raised if the request still fails.
+
+        If the call takes longer than its total timeout, :py:class:`DeadlineError`
+        is raised, and if its cancel token is cancelled, :py:class:`Cancelled`.
+        
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param bool raw: Whether to return the raw body.
+        :param Timeout timeout: How long the call can take (by default the user's).
+        :param CancelToken cancel: A token for abandoning the call.
+        :rtype: dict, list or bytes
+        """
+
+        timeout = Timeout.of(timeout) or self.timeout
+        deadline = timeout.deadline()
+        estimate = estimate_tokens(kwargs.get("json"))
+        if self.rate_limiter: self.rate_limiter.acquire(estimate, deadline, cancel)
+        try:
+            response = self.call(
+                self.send_hedged, method, path, estimate,
+                deadline=deadline, cancel=cancel, stream=True,
+                timeout=timeout.for_requests(), **self.encode(kwargs)
+            )
+            body = self.read(response, deadline, cancel)
+        except BaseException:
+            self.refund(estimate)
+            raise
+        return self.receive(body, estimate, raw)
+    
+
+    def call(self, function, *args, deadline=None, cancel=None, **kwargs):
+        """Calls a function which sends a request, abandoning it if the
+        deadline passes or the cancel token is cancelled first. The deadline
+        and token are passed on to the function, so that it makes no further
+        attempts once abandoned, but an attempt already waiting for the server
+        to answer can't be interrupted - it carries on in the background until
+        the server answers or its read timeout passes, and its response is
+        closed when it arrives. Requests are streamed, so that reading a body
+        can be abandoned straight away with :py:meth:`read`.
+
+        :param function: The function to call.
+        :param float deadline: The monotonic time to give up at, if any.
+        :param CancelToken cancel: A token for abandoning the call.
+        :rtype: requests.Response
+        """
+
+        if deadline is None and cancel is None: return function(*args, **kwargs)
+        if cancel: cancel.check()
+        future = run_in_thread(function, *args, deadline=deadline, cancel=cancel, **kwargs)
+        try:
+            wait_for_future(future, deadline, cancel)
+        except (Cancelled, DeadlineError):
+            future.add_done_callback(discard_response)
+            raise
+        return future.result()
+    
+
+    def read(self, response, deadline=None, cancel=None):
+        """Reads the body of a response in chunks, closing it if the deadline
+        passes or the token is cancelled first - which releases its
+        connection straight away, and raises :py:class:`DeadlineError` or
+        :py:class:`Cancelled`.
+
+        :param requests.Response response: The response to read.
+        :param float deadline: The monotonic time to give up at, if any.
+        :param CancelToken cancel: A token for giving up.
+        :rtype: bytes
+        """
+
+        abandoned = threading.Event()
+        def abandon():
+            abandoned.set()
+            close_response(response)
+        
+        if cancel: cancel.on_cancel(abandon)
+        timer = deadline and threading.Timer(max(deadline - time.monotonic(), 0), abandon)
+        if timer: timer.start()
+        try:
+            with response:
+                body = b"".join(response.iter_content(65536))
+        except (requests.RequestException, OSError, AttributeError, ValueError):
+            if not abandoned.is_set(): raise
+        finally:
+            if cancel: cancel.remove(abandon)
+            if timer: timer.cancel()
+        if abandoned.is_set():
+            if cancel: cancel.check()
+            raise DeadlineError("The request took longer than its total timeout")
+        return body
+    
+
+    def receive(self, body, estimate, raw):
+        """Decodes the body of a response unless it is wanted raw, and settles
+        the tokens it used with the rate limiter (decoding it only if needed
+        for that).
+
+        :param bytes body: The body of the response.
+        :param int estimate: The tokens that were reserved for the request.
+        :param bool raw: Whether to return the raw body.
+        :rtype: dict, list or bytes
+        """
+
+        if raw and not self.rate_limiter: return body
+        data = self.codec.loads(body)
+        self.settle_usage(estimate, data)
+        return body if raw else data
+    
+
+    def settle_usage(self, estimate, data):
+        """Lets the rate limiter know how many tokens a request actually used,
+        if the response data says.
+
+        :param int estimate: The tokens that were reserved for the request.
+        :param data: The JSON data the API responded with.
+        """
+
+        if self.rate_limiter and isinstance(data, dict) and data.get("usage"):
+            self.rate_limiter.settle(estimate, data["usage"]["total_tokens"])
+    
+
+    def refund(self, estimate):
+        """Gives the tokens reserved for a request back to the rate limiter,
+        when it failed without using them.
+
+        :param int estimate: The tokens that were reserved for the request.
+        """
+
+        if self.rate_limiter: self.rate_limiter.settle(estimate, 0)
+    
+
+    def get(self, path):
+        """Make an authorized GET request to the OpenAI API. Returns whatever
+        JSON data the API responds with.
+        
+        :param str path: The path to request.
+        :rtype: dict or list
+        """
+        return self.request("GET", path)
+    
+
+    def post(self, path, raw=False, **kwargs):
+        """Make an authorized POST request to the OpenAI API. Returns whatever
+        JSON data the API responds with, or the raw body if requested. If the
+        user has a cache, chat completions are looked up in it first - when
+        the raw body is requested, what the cache has may be decoded already.
+
+        If the user coalesces completions, a chat completion which is identical
+        to one already in progress isn't sent - the body of the one in progress
+        is shared instead. Sampled completions are shared too, so callers who
+        want different samples should not coalesce.
+        
+        :param str path: The path to request.
+        :param bool raw: Whether to return the raw body.
+        :rtype: dict, list or bytes
+        """
+
+        if (self.cache is None and self.flights is None) \
+         or path != "chat/completions" or "json" not in kwargs:
+            return self.request("POST", path, raw=raw, **kwargs)
+        key = CompletionCache.key(kwargs["json"])
+        data = self.cache.get(key) if self.cache is not None else None
+        if data is None:
+            fetch = lambda: self.request("POST", path, raw=True, **kwargs)
+            if self.flights:
+                timeout = Timeout.of(kwargs.get("timeout")) or self.timeout
+                data = self.flights.run(key, fetch, timeout.deadline(), kwargs.get("cancel"))
+            else:
+                data = fetch()
+            if self.cache is not None: self.cache.put(key, data)
+        return self.codec.loads(data) if isinstance(data, bytes) and not raw else data
+    
+
+    def stream(self, path, timeout=None, cancel=None, **kwargs):
+        """Make an authorized POST request to the OpenAI API which responds
+        with a stream of server-sent events, yielding the JSON data of each
+        event as it arrives. If the token is cancelled, or the total timeout
+        passes, the stream is closed and its connection released straight away.
+        
+        :param str path: The path to request.
+        :param Timeout timeout: How long the call can take (by default the user's).
+        :param CancelToken cancel: A token for abandoning the call.
+        :rtype: Generator[dict]
+        """
+
+        timeout = Timeout.of(timeout) or self.timeout
+        deadline = timeout.deadline()
+        estimate = estimate_tokens(kwargs.get("json"))
+        if self.rate_limiter: self.rate_limiter.acquire(estimate, deadline, cancel)
+        try:
+            response = self.call(
+                self.send_hedged, "POST", path, estimate, deadline=deadline,
+                cancel=cancel, stream=True, timeout=timeout.for_requests(),
+                **self.encode(kwargs)
+            )
+        except BaseException:
+            self.refund(estimate)
+            raise
+        settled = False
+        close = functools.partial(close_response, response)
+        if cancel: cancel.on_cancel(close)
+        timer = deadline and threading.Timer(deadline - time.monotonic(), close)
+        if timer: timer.start()
+        try:
+            with response:
+                for line in response.iter_lines():
+                    if cancel: cancel.check()
+                    if deadline and time.monotonic() > deadline:
+                        raise DeadlineError("The stream took longer than its total timeout")
+                    event = decode_event(line, self.codec)
+                    if event == "[DONE]": break
+                    if event is not None:
+                        self.settle_usage(estimate, event)
+                        settled = settled or bool(event.get("usage"))
+                        yield event
+        except (requests.RequestException, OSError, AttributeError, ValueError):
+            if not settled: self.refund(estimate)
+            if cancel: cancel.check()
+            if deadline and time.monotonic() > deadline:
+                raise DeadlineError("The stream took longer than its total timeout")
+            raise
+        except BaseException:
+            if not settled: self.refund(estimate)
+            raise
+        finally:
+            if cancel: cancel.remove(close)
+            if timer: timer.cancel()
+    
+
+    def models(self):
+        """List the models available to the user. The list is cached, and once
+        it is stale it is refreshed in the background.
+        
+        :rtype: list
+        """
+
+        if self.catalogue.ids is None:
+            self.catalogue.update(self.get("models"))
+        elif self.catalogue.start_refresh():
+            threading.Thread(target=self.refresh_models, daemon=True).start()
+        return list(self.catalogue.ids)
+    
+
+    def refresh_models(self):
+        """Fetches the latest list of models for the user's catalogue."""
+
+        try:
+            self.catalogue.update(self.get("models"))
+        finally:
+            self.catalogue.finish_refresh()
+    
+
+    def model_info(self, model):
+        """Gets the metadata of a model, such as its context window and
+        pricing. This doesn't make a request.
+
+        :param str model: The ID of the model.
+        :rtype: dict
+        """
+
+        return self.catalogue.info(model)
+    
+
+    def validate_agent(self, agent):
+        """Checks that an agent's model is available to the user, raising a
+        ``ValueError`` if not. Only the first check makes a request.
+
+        :param Agent agent: The agent to check.
+        """
+
+        if agent.model not in self.models():
+            raise ValueError(f"Model {agent.model} is not available")
+
+
+    def start_conversation_with_agent(self, agent, message, print=True, typed=True, loop=False, stream=False, policy=None, compaction=None):
+        """Start a conversation with an agent by sending an opening message. A
+        conversation is returned which can then be continued.
+        
+        :param Agent agent: The agent to converse with.
+        :param str message: The opening message.
+        :param bool print: Whether to print the message the agent returns.
+        :param bool typed: Whether to type out the message the agent returns.
+        :param bool loop: Whether to start a loop that continuously prompts.
+        :param bool stream: Whether to stream the message as it is generated.
+        :param HistoryPolicy policy: Which messages to send with each message.
+        :param Compaction compaction: When to summarise older messages.
+        :rtype: Conversation
+        """
+
+        conversation = Conversation(
+            self, agent, [agent.prompt],
+            policy=policy, compaction=compaction, store=self.store
+        )
+        vector = self.semantic_cache.embed(message) if self.semantic_cache else None
+        cached = self.semantic_cache and self.semantic_cache.get(agent, message, vector)
+        if cached:
+            reply = Message("assistant", cached.message, cached)
+            conversation.messages += [Message("user", message), reply]
+            conversation.save()
+            if print: reply.print(typed=typed)
+        else:
+            conversation.message(message, print=print, typed=typed, stream=stream)
+            if self.semantic_cache:
+                self.semantic_cache.put(
+                    agent, message, conversation.messages[-1].response, vector
+                )
+        if loop: conversation.loop(typed=typed, stream=stream)
+        return conversation
+    
+
+    def start_conversations_with_agent(self, agent, messages, workers=8):
+        """Start many conversations with an agent at once, one for each opening
+        message, using a pool of worker threads. The conversations are returned
+        in the same order as the messages. If starting a conversation fails, the
+        exception raised is returned in its place rather than stopping the rest
+        of the batch.
+
+        :param Agent agent: The agent to converse with.
+        :param list messages: The opening messages.
+        :param int workers: The most requests to have in progress at once.
+        :rtype: list
+        """
+
+        def start(message):
+            try:
+                return self.start_conversation_with_agent(agent, message, print=False)
+            except Exception as e:
+                return e
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(start, messages))
+    
+
+    def send_messages(self, pairs, workers=8):
+        """Continue many conversations at once, by sending each one a message,
+        using a pool of worker threads. The reply messages are returned in the
+        same order as the pairs given. If a message fails, the exception raised
+        is returned in its place rather than stopping the rest of the batch.
+
+        A conversation should only appear once in a batch, as its messages
+        depend on the replies before them.
+
+        :param list pairs: (conversation, content) pairs to send.
+        :param int workers: The most requests to have in progress at once.
+        :rtype: list
+        """
+
+        def send(pair):
+            try:
+                return pair[0].message(pair[1], print=False)
+            except Exception as e:
+                return e
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(send, pairs))
+
+
+
+class UserPool(User):
+    """A pool of API keys which is used like a single :py:class:`User`, so that
+    throughput isn't capped by one key's quota. Each key gets its own user,
+    and they all share one HTTP session and the pool's caches and store.
+
+    Each request goes to the key with the most quota left, as reported by the
+    API. A key which hits its rate limit is taken out of rotation until the API
+    says it will have reset (or for ``cooldown`` seconds if it doesn't say),
+    and the request is sent with another key straight away. Only once every
+    key has hit its limit is the error left to the retry policy.
+
+    OpenAI's prompt cache is per organisation, so by default each conversation
+    started by the pool is pinned to one key - its user is that key's user,
+    chosen when it starts - and its requests can be served from the cache.
+    With ``pin=False``, every request of every conversation is balanced.
+
+    :param list openai_keys: The API keys to use.
+    :param requests.Session session: The HTTP session to make requests with.
+    :param int pool_size: The connections per host if a session is created.
+    :param RetryPolicy retry: How to retry failed requests (``None`` to not).
+    :param CompletionCache cache: Where to cache chat completions, if anywhere.
+    :param SemanticCache semantic_cache: Where to cache replies to openers.
+    :param SQLiteStore store: Where to save conversations the pool starts.
+    :param JSONCodec codec: The JSON codec to use (by default the fastest).
+    :param bool pin: Whether to keep each conversation to one key.
+    :param float cooldown: How long to bench a rate limited key by default.
+    :param base_url: The API's base URL, or a :py:class:`Router`.
+    :param Hedging hedging: How to hedge slow chat completions, if at all.
+    :param bool coalesce: Whether to share identical concurrent completions.
+    :param Timeout timeout: How long requests can take.
+    :param float catalogue_ttl: How many seconds the list of models is fresh for.
+    :param dict catalogue_metadata: Model metadata to use instead of the bundled table's.
+    """
+
+    def __init__(
+        self, openai_keys, session=None, pool_size=10, retry=DEFAULT, cache=None,
+        semantic_cache=None, store=None, codec=None, pin=True, cooldown=10, **kwargs
+    ):
+        if not openai_keys: raise ValueError("A pool needs at least one key")
+        super().__init__(
+            openai_keys[0], session, pool_size, retry=retry, cache=cache,
+            semantic_cache=semantic_cache, store=store, codec=codec, **kwargs
+        )
+        self.users = [User(
+            key, session=self.session, retry=self.retry, cache=cache,
+            semantic_cache=semantic_cache, store=store, codec=codec,
+            base_url=self.router, hedging=self.hedging, timeout=self.timeout,
+            catalogue_ttl=self.catalogue.ttl, catalogue_metadata=self.catalogue.metadata
+        ) for key in openai_keys]
+        for user in self.users: user.flights = self.flights
+        self.pin = pin
+        self.cooldown = cooldown
+        self.turn = 0
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        return f"UserPool({len(self.users)} keys)"
+    
+
+    def choose(self, exclude=()):
+        """Picks the user whose key has the most quota left, out of those not
+        benched - or if they all are, the one back in rotation soonest. Keys
+        which look equally good are taken in turn.
+
+        :param exclude: Users not to pick.
+        :rtype: User
+        """
+
+        with self.lock:
+            self.turn += 1
+            start = self.turn % len(self.users)
+        users = [u for u in self.users[start:] + self.users[:start] if u not in exclude]
+        ready = [user for user in users if not user.quota.benched]
+        if not ready: return min(users, key=lambda user: user.quota.benched_until)
+        return max(ready, key=lambda user: user.quota.headroom)
+    
+
+    def send(self, method, path, estimate=0, **kwargs):
+        """Makes a single attempt at an authorized request to the OpenAI API
+        with the best key available, and returns the HTTP response. If the
+        key is rate limited it is benched, and the request is made again with
+        the next best, until every key has been tried. A key whose account is
+        out of credit isn't benched - the error is raised.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :rtype: requests.Response
+        """
+
+        tried = set()
+        while True:
+            user = self.choose(exclude=tried)
+            try:
+                return user.send(method, path, estimate, **kwargs)
+            except APIError as e:
+                if e.status != 429 or e.quota_exhausted: raise
+                wait = self.retry.suggested_wait(e) if self.retry else None
+                user.quota.bench(self.cooldown if wait is None else wait)
+                tried.add(user)
+                if len(tried) == len(self.users): raise
+    
+
+    def start_conversation_with_agent(self, agent, message, print=True, typed=True, loop=False, stream=False, policy=None, compaction=None):
+        """Start a conversation with an agent by sending an opening message. A
+        conversation is returned which can then be continued. If the pool pins
+        conversations, it is started by the user whose key has the most quota
+        left, and stays with that key.
+        
+        :param Agent agent: The agent to converse with.
+        :param str message: The opening message.
+        :param bool print: Whether to print the message the agent returns.
+        :param bool typed: Whether to type out the message the agent returns.
+        :param bool loop: Whether to start a loop that continuously prompts.
+        :param bool stream: Whether to stream the message as it is generated.
+        :param HistoryPolicy policy: Which messages to send with each message.
+        :param Compaction compaction: When to summarise older messages.
+        :rtype: Conversation
+        """
+
+        user = self.choose() if self.pin else super()
+        return user.start_conversation_with_agent(
+            agent, message, print=print, typed=typed, loop=loop,
+            stream=stream, policy=policy, compaction=compaction
+        )
+
+
+
+class AsyncUser(User):
+    """A user of the OpenAI API whose requests are made without blocking, on
+    an asyncio event loop. This requires the ``aiohttp`` library.
+
+    The HTTP session is created the first time a request is made, as it must
+    belong to a running event loop, and should be closed when finished with -
+    either with :py:meth:`close` or by using the user as an async context
+    manager.
+
+    :param str openai_key: The API key for the user.
+    :param aiohttp.ClientSession session: The HTTP session to make requests with.
+    :param int pool_size: The connections per host if a session is created.
+    :param RateLimiter rate_limiter: Paces requests to stay within quotas.
+    :param RetryPolicy retry: How to retry failed requests (``None`` to not).
+    :param CompletionCache cache: Where to cache chat completions, if anywhere.
+    :param SemanticCache semantic_cache: Where to cache replies to openers.
+    :param SQLiteStore store: Where to save conversations the user starts.
+    :param JSONCodec codec: The JSON codec to use (by default the fastest).
+    :param base_url: The API's base URL, or a :py:class:`Router`.
+    :param Hedging hedging: How to hedge slow chat completions, if at all.
+    :param bool coalesce: Whether to share identical concurrent completions.
+    :param Timeout timeout: How long requests can take.
+    :param float catalogue_ttl: How many seconds the list of models is fresh for.
+    :param dict catalogue_metadata: Model metadata to use instead of the bundled table's.
+    """
+
+    def __init__(self, openai_key, session=None, pool_size=100, **kwargs):
+        if aiohttp is None:
+            raise ImportError("AsyncUser requires aiohttp to be installed")
+        super().__init__(openai_key, session, pool_size, **kwargs)
+        self.refresh_task = None
+    
+
+    async def __aenter__(self):
+        return self
+    
+
+    async def __aexit__(self, *args):
+        await self.close()
+    
+
+    def new_session(self):
+        """Doesn't create a session, as it must belong to a running event loop
+        - :py:meth:`get_session` creates one when the first request is made.
+        """
+
+        return None
+    
+
+    def get_session(self):
+        """Gets the HTTP session that requests are made with, creating one with
+        its own connection pool if there isn't one yet.
+
+        :rtype: aiohttp.ClientSession
+        """
+
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+    
+
+    async def close(self):
+        """Closes the HTTP session and its open connections."""
+
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+    async def send(self, method, path, estimate=0, **kwargs):
+        """Makes a single attempt at an authorized request to the OpenAI API,
+        and returns the HTTP response, which should be used as an async context
+        manager so that its connection is released. An :py:class:`APIError` is
+        raised if the API responds with an error status. Requests are routed
+        between endpoints as they are by :py:meth:`User.send`.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :rtype: aiohttp.ClientResponse
+        """
+
+        self.quota.reserve(estimate)
+        tried = []
+        while True:
+            endpoint = self.router.choose(exclude=tried)
+            tried.append(endpoint)
+            last = len(tried) >= len(self.router.endpoints)
+            start = time.monotonic()
+            try:
+                response = await self.get_session().request(
+                    method, endpoint.url + path, headers=self.headers, **kwargs
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.router.fail(endpoint)
+                if last: raise
+                continue
+            if response.status < 500:
+                self.router.succeed(endpoint, time.monotonic() - start)
+            else:
+                self.router.fail(endpoint)
+                if not last:
+                    response.release()
+                    continue
+            break
+        self.quota.observe(response.headers)
+        if response.status >= 400:
+            async with response:
+                body = await response.read()
+            raise APIError.from_body(response.status, body, response.headers)
+        return response
+    
+
+    async def send_with_retries(self, method, path, estimate=0, **kwargs):
+        """Sends an authorized request to the OpenAI API, retrying it according
+        to the user's retry policy if it fails, and returns the HTTP response.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :rtype: aiohttp.ClientResponse
+        """
+
+        start, attempt = time.monotonic(), 0
+        while True:
+            try:
+                return await self.send(method, path, estimate, **kwargs)
+            except Exception as e:
+                wait = self.retry.wait(e, attempt, start) if self.retry else None
+                if wait is None: raise
+                await asyncio.sleep(wait)
+                attempt += 1
+    
+
+    async def send_hedged(self, method, path, estimate=0, **kwargs):
+        """Sends an authorized request to the OpenAI API with retries, hedging
+        it if the user hedges chat completions and it is one, and returns the
+        HTTP response. A hedge which loses is cancelled.
+
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param int estimate: The tokens the request is expected to use.
+        :rtype: aiohttp.ClientResponse
+        """
+
+        hedging = self.hedging
+        if hedging is None or path != "chat/completions":
+            return await self.send_with_retries(method, path, estimate, **kwargs)
+        start = time.monotonic()
+        attempts = [asyncio.ensure_future(self.send_with_retries(method, path, estimate, **kwargs))]
+        winner, error = None, None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=hedging.delay())
+            if not done and hedging.allow():
+                attempts.append(asyncio.ensure_future(
+                    self.send_with_retries(method, path, estimate, **kwargs)
+                ))
+            pending = set(attempts)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif winner is None:
+                        winner = task
+        finally:
+            for task in attempts:
+                if task is winner: continue
+                if task.done():
+                    discard_response(task)
+                else:
+                    task.cancel()
+        if winner is None: raise error
+        hedging.record(time.monotonic() - start, won=winner is not attempts[0])
+        return winner.result()
+
+
+    async def request(self, method, path, raw=False, timeout=None, **kwargs):
+        """Make an authorized request to the OpenAI API. Returns whatever JSON
+        data the API responds with - or the raw body, without decoding it, if
+        requested. Transient failures are retried, and an
+        :py:class:`APIError` is raised if the request still fails.
+
+        If the call takes longer than its total timeout,
+        ``asyncio.TimeoutError`` is raised. Cancelling the task making the
+        call abandons the request and releases its connection.
+        
+        :param str method: The HTTP method to use.
+        :param str path: The path to request.
+        :param bool raw: Whether to return the raw body.
+        :param Timeout timeout: How long the call can take (by default the user's).
+        :rtype: dict, list or bytes
+        """
+
+        timeout = Timeout.of(timeout) or self.timeout
+        estimate = estimate_tokens(kwargs.get("json"))
+        acquired = False
+
+        async def fetch():
+            nonlocal acquired
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async(estimate)
+                acquired = True
+            response = await self.send_hedged(
+                method, path, estimate,
+                timeout=timeout.for_aiohttp(), **self.encode(kwargs)
+            )
+            async with response:
+                return await response.read()
+        
+        try:
+            body = await asyncio.wait_for(fetch(), timeout.total)
+        except BaseException:
+            if acquired: self.refund(estimate)
+            raise
+        return self.receive(body, estimate, raw)
+    
+
+    async def get(self, path):
+        """Make an authorized GET request to the OpenAI API. Returns whatever
+        JSON data the API responds with.
+        
+        :param str path: The path to request.
+        :rtype: dict or list
+        """
+
+        return await self.request("GET", path)
+    
+
+    async def post(self, path, raw=False, **kwargs):
+        """Make an authorized POST request to the OpenAI API. Returns whatever
+        JSON data the API responds with, or the raw body if requested. If the
+        user has a cache, chat completions are looked up in it first - when
+        the raw body is requested, what the cache has may be decoded already.
+        Identical completions are coalesced as they are by :py:meth:`User.post`.
+        
+        :param str path: The path to request.
+        :param bool raw: Whether to return the raw body.
+        :rtype: dict, list or bytes
+        """
+
+        if (self.cache is None and self.flights is None) \
+         or path != "chat/completions" or "json" not in kwargs:
+            return await self.request("POST", path, raw=raw, **kwargs)
+        key = CompletionCache.key(kwargs["json"])
+        data = self.cache.get(key) if self.cache is not None else None
+        if data is None:
+            fetch = lambda: self.request("POST", path, raw=True, **kwargs)
+            if self.flights:
+                timeout = Timeout.of(kwargs.get("timeout")) or self.timeout
+                data = await asyncio.wait_for(self.flights.run_async(key, fetch), timeout.total)
+            else:
+                data = await fetch()
+            if self.cache is not None: self.cache.put(key, data)
+        return self.codec.loads(data) if isinstance(data, bytes) and not raw else data
+    
+
+    async def stream(self, path, timeout=None, **kwargs):
+        """Make an authorized POST request to the OpenAI API which responds
+        with a stream of server-sent events, yielding the JSON data of each
+        event as it arrives.
+        
+        :param str path: The path to request.
+        :param Timeout timeout: How long the call can take (by default the user's).
+        :rtype: AsyncGenerator[dict]
+        """
+
+        timeout = Timeout.of(timeout) or self.timeout
+        deadline = timeout.deadline()
+        estimate = estimate_tokens(kwargs.get("json"))
+        remaining = lambda: None if deadline is None else max(deadline - time.monotonic(), 0)
+        acquired, settled = False, False
+        try:
+            if self.rate_limiter:
+                await asyncio.wait_for(self.rate_limiter.acquire_async(estimate), remaining())
+                acquired = True
+            response = await asyncio.wait_for(self.send_hedged(
+                "POST", path, estimate,
+                timeout=timeout.for_aiohttp(), **self.encode(kwargs)
+            ), remaining())
+            async with response:
+                lines = response.content.__aiter__()
+                while True:
+                    try:
+                        if deadline is None:
+                            line = await lines.__anext__()
+                        else:
+                            line = await asyncio.wait_for(lines.__anext__(), remaining())
+                    except StopAsyncIteration:
+                        break
+                    event = decode_event(line, self.codec)
+                    if event == "[DONE]": break
+                    if event is not None:
+                        self.settle_usage(estimate, event)
+                        settled = settled or bool(event.get("usage"))
+                        yield event
+        except BaseException:
+            if acquired and not settled: self.refund(estimate)
+            raise
+    
+
+    async def models(self):
+        """List the models available to the user. The list is cached, and once
+        it is stale it is refreshed in a separate task.
+        
+        :rtype: list
+        """
+
+        if self.catalogue.ids is None:
+            self.catalogue.update(await self.get("models"))
+        elif self.catalogue.start_refresh():
+            self.refresh_task = asyncio.create_task(self.refresh_models())
+        return list(self.catalogue.ids)
+    
+
+    async def refresh_models(self):
+        """Fetches the latest list of models for the user's catalogue."""
+
+        try:
+            self.catalogue.update(await self.get("models"))
+        finally:
+            self.catalogue.finish_refresh()
+    
+
+    async def validate_agent(self, agent):
+        """Checks that an agent's model is available to the user, raising a
+        ``ValueError`` if not. Only the first check makes a request.
+
+        :param Agent agent: The agent to check.
+        """
+
+        if agent.model not in await self.models():
+            raise ValueError(f"Model {agent.model} is not available")
+
+
+    async def start_conversation_with_agent(self, agent, message, print=False, typed=False, stream=False, policy=None, compaction=None):
+        """Start a conversation with an agent by sending an opening message. A
+        conversation is returned which can then be continued.
+
+        Printing is off by default, as many conversations will usually be in
+        progress at once.
+        
+        :param Agent agent: The agent to converse with.
+        :param str message: The opening message.
+        :param bool print: Whether to print the message the agent returns.
+        :param bool typed: Whether to type out the message the agent returns.
+        :param bool stream: Whether to stream the message as it is generated.
+        :param HistoryPolicy policy: Which messages to send with each message.
+        :param Compaction compaction: When to summarise older messages.
+        :rtype: AsyncConversation
+        """
+
+        conversation = AsyncConversation(
+            self, agent, [agent.prompt],
+            policy=policy, compaction=compaction, store=self.store
+        )
+        vector = self.semantic_cache.embed(message) if self.semantic_cache else None
+        cached = self.semantic_cache and self.semantic_cache.get(agent, message, vector)
+        if cached:
+            reply = Message("assistant", cached.message, cached)
+            conversation.messages += [Message("user", message), reply]
+            conversation.save()
+            if print: await reply.print_async(typed=typed)
+        else:
+            await conversation.message(message, print=print, typed=typed, stream=stream)
+            if self.semantic_cache:
+                self.semantic_cache.put(
+                    agent, message, conversation.messages[-1].response, vector
+                )
+        return conversation
+    
+
+    async def start_conversations_with_agent(self, agent, messages, workers=100):
+        """Start many conversations with an agent at once, one for each opening
+        message. The conversations are returned in the same order as the
+        messages. If starting a conversation fails, the exception raised is
+        returned in its place rather than stopping the rest of the batch.
+
+        :param Agent agent: The agent to converse with.
+        :param list messages: The opening messages.
+        :param int workers: The most requests to have in progress at once.
+        :rtype: list
+        """
+
+        semaphore = asyncio.Semaphore(workers)
+        async def start(message):
+            async with semaphore:
+                return await self.start_conversation_with_agent(agent, message)
+        
+        return await asyncio.gather(
+            *[start(message) for message in messages], return_exceptions=True
+        )
+    
+
+    async def send_messages(self, pairs, workers=100):
+        """Continue many conversations at once, by sending each one a message.
+        The reply messages are returned in the same order as the pairs given.
+        If a message fails, the exception raised is returned in its place rather
+        than stopping the rest of the batch.
+
+        A conversation should only appear once in a batch, as its messages
+        depend on the replies before them.
+
+        :param list pairs: (conversation, content) pairs to send.
+        :param int workers: The most requests to have in progress at once.
+        :rtype: list
+        """
+
+        semaphore = asyncio.Semaphore(workers)
+        async def send(conversation, content):
+            async with semaphore:
+                return await conversation.message(content)
+        
+        return await asyncio.gather(
+            *[send(*pair) for pair in pairs], return_exceptions=True
+        )
+
+
+
+class HistoryPolicy(abc.ABC):
+    """A rule for which of a conversation's messages are sent to the agent with
+    each new message, so that long conversations don't resend their whole
+    history every time. The conversation itself keeps every message - the
+    policy only decides what goes in the request.
+
+    System messages and pinned messages are always sent. Subclasses must
+    implement :py:meth:`start`, which decides where the run of recent messages
+    that is also sent should start.
+    """
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
+    
+
+    def is_kept(self, message):
+        """Whether a message is always sent, however old it is.
+
+        :param Message message: The message to check.
+        :rtype: bool
+        """
+
+        return message.role == "system" or message.pinned
+    
+
+    @abc.abstractmethod
+    def start(self, messages, model=None):
+        """Gets the index of the earliest recent message to send.
+
+        :param list messages: The conversation's messages.
+        :param str model: The ID of the model the messages are for.
+        :rtype: int
+        """
+    
+
+    def select(self, messages, model=None):
+        """Picks out the messages to send.
+
+        :param list messages: The conversation's messages.
+        :param str model: The ID of the model the messages are for.
+        :rtype: list
+        """
+
+        start = self.start(messages, model)
+        return [
+            message for i, message in enumerate(messages)
+            if i >= start or self.is_kept(message)
+        ]
+
+
+
+class KeepLastTokens(HistoryPolicy):
+    """A history policy which sends as many of the most recent messages as fit
+    in a token budget, along with the system prompt and any pinned messages.
+    The newest message is always sent, even if it is over budget alone.
+
+    :param int tokens: The most tokens to send.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+    
+
+    def __repr__(self):
+        return f"KeepLastTokens({self.tokens})"
+    
+
+    def start(self, messages, model=None):
+        budget = self.tokens - TOKENS_PER_REPLY - sum(
+            message.count_tokens(model) for message in messages if self.is_kept(message)
+        )
+        start = len(messages)
+        while start > 0:
+            message = messages[start - 1]
+            if not self.is_kept(message):
+                budget -= message.count_tokens(model)
+                if budget < 0 and start < len(messages): break
+            start -= 1
+        return start
+
+
+
+class KeepLastTurns(HistoryPolicy):
+    """A history policy which sends only the most recent turns of the
+    conversation, dropping the oldest, along with the system prompt and any
+    pinned messages. A turn is a user message and the replies that follow it.
+
+    :param int turns: The number of turns to send (at least one).
+    """
+
+    def __init__(self, turns):
+        if turns < 1: raise ValueError("At least one turn must be sent")
+        self.turns = turns
     
-    :param str openai_key: The API key for the user.
+
+    def __repr__(self):
+        return f"KeepLastTurns({self.turns})"
+    
+
+    def start(self, messages, model=None):
+        turns = 0
+        for start in range(len(messages) - 1, -1, -1):
+            if messages[start].role == "user":
+                turns += 1
+                if turns == self.turns: return start
+        return 0
+
+
+
+class Compaction:
+    """A rule for condensing a long conversation. Once the messages sent with
+    each new message pass a token threshold, all but the most recent turns are
+    summarised by a (usually cheaper) agent, and the summary is sent in their
+    place from then on. Later compactions summarise the previous summary along
+    with the turns since, so the amount sent stays bounded however long the
+    conversation gets. As with history policies, the conversation itself keeps
+    every message.
+
+    By default summaries are made in the background, and used from the first
+    message sent after they are ready, so that no message has to wait for one.
+
+    :param Agent agent: The agent which writes summaries.
+    :param int threshold: The tokens sent which trigger a compaction.
+    :param int keep_turns: The number of recent turns to leave unsummarised.
+    :param bool background: Whether to summarise without blocking.
     """
 
-    def __init__(self, openai_key):
-        self.openai_key = openai_key
+    PROMPT = (
+        "You will be given the transcript of a conversation between a user and "
+        "an assistant. Summarise it so that the conversation can be continued "
+        "from the summary alone, keeping every fact, name, decision and open "
+        "question. Be concise."
+    )
+
+    def __init__(self, agent=None, threshold=8000, keep_turns=2, background=True):
+        self.agent = agent or Agent("gpt-4o-mini", self.PROMPT)
+        self.threshold = threshold
+        self.keep_turns = keep_turns
+        self.background = background
+        self.executor = None
     
 
     def __repr__(self):
-        truncated_key = self.openai_key[:13] + "..." + self.openai_key[-5:]
-        return f"User({truncated_key})"
+        return f"Compaction({self.agent.model}, {self.threshold})"
     
 
-    def request(self, method, path, **kwargs):
-        """Make an authorized request to the OpenAI API. Returns whatever JSON
-        data the API responds with.
+    def cut(self, conversation):
+        """Gets the index of the first message in a conversation that should
+        be left out of the next summary, or ``None`` if a compaction isn't due.
+
+        :param Conversation conversation: The conversation to check.
+        :rtype: int
+        """
+
+        model = conversation.agent.model
+        tokens = TOKENS_PER_REPLY + sum(
+            message.count_tokens(model) for message in conversation.context()
+        )
+        if tokens <= self.threshold: return None
+        cut = KeepLastTurns(self.keep_turns).start(conversation.messages)
+        return cut if cut > conversation.summarized else None
+    
+
+    def summary_json(self, conversation, cut):
+        """The request body for summarising a conversation up to a point,
+        starting from its current summary if it has one.
+
+        :param Conversation conversation: The conversation to summarise.
+        :param int cut: The index of the first message not to summarise.
+        :rtype: dict
+        """
+
+        lines = [conversation.summary.content] if conversation.summary else []
+        for message in conversation.messages[conversation.summarized:cut]:
+            if message.role != "system":
+                lines.append(f"[{message.role}] {message.content}")
+        return {"model": self.agent.model, **self.agent.parameters, "messages": [
+            self.agent.prompt.to_dict(),
+            {"role": "user", "content": "\n\n".join(lines)},
+        ]}
+    
+
+    def summary_message(self, data):
+        """Creates the message which stands in for the summarised part of a
+        conversation, from the API's response.
+
+        :param dict data: The JSON data from the API.
+        :rtype: Message
+        """
+
+        response = Response(data)
+        return Message(
+            "system", f"Summary of the conversation so far:\n{response.message}",
+            response
+        )
+    
+
+    def submit(self, function, *args):
+        """Runs a function in the background, on a pool of worker threads.
+
+        :param function: The function to run.
+        :rtype: concurrent.futures.Future
+        """
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=4)
+        return self.executor.submit(function, *args)
+
+
+
+class Agent:
+    """An agent that can participate in conversations.
+    
+    Any other keyword arguments are generation parameters (``temperature``,
+    ``max_tokens`` etc.) which are sent with every request the agent answers.
+
+    The agent keeps count of how many of the prompt tokens in its responses
+    were served from OpenAI's prompt cache, across all its conversations.
+    Only the usage of a response which hasn't been decoded is read for this,
+    so counting doesn't decode it.
+    
+    :param str model: The ID of the model to use.
+    :param str prompt: The initial prompt to use.
+    """
+
+    def __init__(self, model, prompt, **parameters):
+        self.model = model
+        self.prompt = Message("system", prompt)
+        self.parameters = parameters
+        self._prompt_tokens_used = 0
+        self._cached_tokens_used = 0
+        self.lock = threading.Lock()
+    
+
+    def __repr__(self):
+        prompt = self.prompt.content
+        if len(prompt) > 40: prompt = f"{prompt[:37]}..."
+        return f"Agent({prompt})"
+    
+
+    def record(self, response):
+        """Adds a response the agent gave to its token counts.
+
+        :param Response response: The response.
+        """
+
+        prompt_tokens, cached_tokens = response.usage()
+        with self.lock:
+            self._prompt_tokens_used += prompt_tokens
+            self._cached_tokens_used += cached_tokens
+    
+
+    @property
+    def prompt_tokens_used(self):
+        """The number of prompt tokens used in the agent's responses.
+
+        :rtype: int
+        """
+
+        return self._prompt_tokens_used
+    
+
+    @property
+    def cached_tokens_used(self):
+        """The number of prompt tokens in the agent's responses which were
+        served from OpenAI's prompt cache.
+
+        :rtype: int
+        """
+
+        return self._cached_tokens_used
+    
+
+    @property
+    def cache_hit_rate(self):
+        """The fraction of prompt tokens in the agent's responses which were
+        served from OpenAI's prompt cache.
+
+        :rtype: float
+        """
+
+        used = self._prompt_tokens_used
+        return self._cached_tokens_used / used if used else 0
+
+
+
+class Response:
+    """A response from an agent in a conversation. This is a wrapper around an
+    OpenAI completion.
+
+    Responses use slots rather than an instance dictionary, as a process may
+    hold a great many of them, and the list of choices is only stored when
+    there is more than one.
+
+    A response can be created from the raw body of the API's response instead
+    of decoded JSON, in which case the body isn't decoded until one of the
+    response's attributes is first read - so responses which are never looked
+    at are never decoded. The same response can be read from many threads at
+    once.
+    
+    :param json: The JSON data from the API, decoded or raw.
+    :param JSONCodec codec: The codec to decode a raw body with.
+    """
+
+    __slots__ = (
+        "_raw", "_codec", "id", "created", "model", "system_fingerprint",
+        "message", "_choices", "finish_reason", "logprobs",
+        "prompt_tokens_used", "completion_tokens_used", "tokens_used",
+        "cached_tokens_used",
+    )
+
+    def __init__(self, json, codec=None):
+        self._raw = None
+        self._codec = codec
+        if isinstance(json, (bytes, str)):
+            self._raw = json
+        else:
+            self.load(json)
+    
+
+    def __getattr__(self, name):
+        raw = self._raw
+        if raw is None or name.startswith("__"): raise AttributeError(name)
+        self.load((self._codec or CODEC).loads(raw))
+        self._raw = None
+        return getattr(self, name)
+    
+
+    def load(self, json):
+        """Takes the response's attributes from the API's JSON data.
+
+        :param dict json: The JSON data from the API.
+        """
+
+        self.id = json["id"]
+        self.created = json["created"]
+        self.model = json.get("model")
+        self.system_fingerprint = json.get("system_fingerprint")
+        choices = json["choices"]
+        self.message = choices[0]["message"]["content"]
+        self._choices = [
+            choice["message"]["content"] for choice in choices
+        ] if len(choices) > 1 else None
+        self.finish_reason = choices[0].get("finish_reason")
+        self.logprobs = choices[0].get("logprobs")
+        self.prompt_tokens_used = json["usage"]["prompt_tokens"]
+        self.completion_tokens_used = json["usage"]["completion_tokens"]
+        self.tokens_used = json["usage"]["total_tokens"]
+        details = json["usage"].get("prompt_tokens_details") or {}
+        self.cached_tokens_used = details.get("cached_tokens") or 0
+    
+
+    @property
+    def decoded(self):
+        """Whether the response's JSON has been decoded yet.
+
+        :rtype: bool
+        """
+
+        return self._raw is None
+    
+
+    def usage(self):
+        """Gets the prompt tokens the response used, and how many of them were
+        served from the prompt cache. If the response hasn't been decoded,
+        only its usage is read from the raw body, and it stays undecoded.
+
+        :rtype: tuple
+        """
+
+        raw = self._raw
+        usage = None if raw is None else read_usage(raw)
+        if usage is None: return self.prompt_tokens_used, self.cached_tokens_used
+        details = usage.get("prompt_tokens_details") or {}
+        return usage["prompt_tokens"], details.get("cached_tokens") or 0
+    
+
+    @property
+    def choices(self):
+        """The content of each of the alternative messages the API returned.
+
+        :rtype: list
+        """
+
+        return [self.message] if self._choices is None else self._choices
+    
+
+    def __repr__(self):
+        truncated = self.message
+        if len(truncated) > 40: truncated = f"{truncated[:37]}..."
+        return f"Response({truncated})"
+    
+
+    def to_dict(self):
+        """Converts the response back to a dictionary in the format the OpenAI
+        API sends, from which an identical response can be created.
+
+        :rtype: dict
+        """
+
+        data = {
+            "id": self.id,
+            "created": self.created,
+            "choices": [
+                {"message": {"role": "assistant", "content": choice}}
+                for choice in self.choices
+            ],
+            "usage": {
+                "prompt_tokens": self.prompt_tokens_used,
+                "completion_tokens": self.completion_tokens_used,
+                "total_tokens": self.tokens_used,
+            },
+        }
+        if self.model: data["model"] = self.model
+        if self.system_fingerprint: data["system_fingerprint"] = self.system_fingerprint
+        if self.finish_reason: data["choices"][0]["finish_reason"] = self.finish_reason
+        if self.logprobs: data["choices"][0]["logprobs"] = self.logprobs
+        if self.cached_tokens_used:
+            data["usage"]["prompt_tokens_details"] = {"cached_tokens": self.cached_tokens_used}
+        return data
+    
+
+    @staticmethod
+    def empty():
+        """Creates the JSON data of a completion with no content yet, which a
+        streamed completion can be merged into chunk by chunk.
+
+        :rtype: dict
+        """
+
+        return {
+            "id": None, "created": None, "choices": [],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+
+
+class Message:
+    """A message in a conversation.
+
+    Messages use slots rather than an instance dictionary, as a process may
+    hold a great many of them, and their roles are interned so that every
+    message with the same role shares one string.
+    
+    If no content is given, the content is that of the response's message,
+    which is only read from the response when needed.
+    
+    :param str role: The role of the message ("assistant", "system" etc.).
+    :param str content: The content of the message.
+    :param Response response: The API response that generated this message.
+    :param bool pinned: Whether history policies should always send it.
+    """
+
+    __slots__ = ("role", "_content", "response", "pinned", "_dict", "_tokens")
+
+    def __init__(self, role, content, response=None, pinned=False):
+        self.role = sys.intern(role)
+        self._content = content
+        self.response = response
+        self.pinned = pinned
+        self._dict = None
+        self._tokens = None
+    
+
+    def __repr__(self):
+        truncated = self.content
+        if len(truncated) > 40: truncated = f"{truncated[:37]}..."
+        return f"Message([{self.role}] {truncated})"
+    
+
+    @property
+    def content(self):
+        """The content of the message.
+
+        :rtype: str
+        """
+
+        if self._content is None and self.response is not None:
+            return self.response.message
+        return self._content
+    
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+    
+
+    def to_dict(self):
+        """Converts the message to a dictionary, in the format expected by the
+        OpenAI API. The same dictionary is returned each time until the
+        message is changed.
         
-        :param str method: The HTTP method to use.
-        :param str path: The path to request.
-        :rtype: dict or list
+        :rtype: dict
+        """
+
+        if self._dict is None or self._dict["content"] is not self.content \
+         or self._dict["role"] is not self.role:
+            self._dict = {"role": self.role, "content": self.content}
+        return self._dict
+    
+
+    def count_tokens(self, model=None):
+        """Counts the tokens the message takes up in a request, including the
+        tokens that frame each message. The count is cached until the content
+        changes.
+
+        :param str model: The ID of the model the message is for.
+        :rtype: int
+        """
+
+        if self._tokens and self._tokens[0] is self.content and self._tokens[1] == model:
+            return self._tokens[2]
+        count = count_tokens(self.content, model) + TOKENS_PER_MESSAGE
+        self._tokens = (self.content, model, count)
+        return count
+
+
+    def to_json(self):
+        """Converts the message to a dictionary which can be saved as JSON,
+        including its response.
+
+        :rtype: dict
+        """
+
+        data = {"role": self.role, "content": self.content}
+        if self.response: data["response"] = self.response.to_dict()
+        if self.pinned: data["pinned"] = True
+        return data
+    
+
+    @staticmethod
+    def from_json(data):
+        """Creates a message from a dictionary made by :py:meth:`to_json`.
+
+        :param dict data: The message's data.
+        :rtype: Message
+        """
+
+        response = Response(data["response"]) if data.get("response") else None
+        return Message(data["role"], data["content"], response, data.get("pinned", False))
+
+
+    def print(self, typed=False):
+        """Prints the message to the console, optionally typing it out one
+        character at a time.
+        
+        :param bool typed: Whether to type out the message.
+        """
+
+        if not typed:
+            print(self.content)
+            return
+        for char in self.content:
+            delay = random.uniform(0.01, 0.05)
+            print(char, end="", flush=True)
+            time.sleep(delay)
+        print()
+    
+
+    async def print_async(self, typed=False):
+        """Prints the message to the console, optionally typing it out one
+        character at a time without blocking the event loop.
+        
+        :param bool typed: Whether to type out the message.
         """
 
-        response = requests.request(
-            method,
-            f"https://api.openai.com/v1/{path}",
-            headers={
-                "Authorization": f"Bearer {self.openai_key}",
-                "Content-Type": "application/json",
-            },
-            **kwargs
-        )
-        return response.json()
+        if not typed:
+            print(self.content)
+            return
+        for char in self.content:
+            delay = random.uniform(0.01, 0.05)
+            print(char, end="", flush=True)
+            await asyncio.sleep(delay)
+        print()
+
+
+
+class History(MutableSequence):
+    """The messages of a conversation - a list which can share its start with
+    other histories. Forking a history creates a new one which refers to the
+    first part of the original rather than copying it, and only stores the
+    messages added to it after that, so any number of branches can be made
+    from a long history cheaply.
+
+    Histories are mutable sequences, and compare equal to lists of the same
+    messages, but only the messages a history stores itself can be replaced,
+    removed or inserted among - the shared part belongs to the history it was
+    forked from, and touching it raises ``IndexError``. Clearing a history
+    just lets go of the shared part. Each history also keeps the API
+    dictionaries of its own messages, so that branches share those too.
+
+    :param list messages: The messages the history stores itself.
+    :param History parent: The history this one was forked from.
+    :param int length: The number of the parent's messages this one shares.
+    """
+
+    __slots__ = ("parent", "length", "own", "dicts")
+
+    def __init__(self, messages=None, parent=None, length=0):
+        self.parent = parent
+        self.length = length
+        self.own = [] if messages is None else messages
+        self.dicts = []
+    
+
+    def __repr__(self):
+        return f"History({len(self)} messages, {len(self.own)} own)"
+    
+
+    def __len__(self):
+        return self.length + len(self.own)
+    
+
+    def __iter__(self):
+        for node, count in self.segments():
+            yield from node.own[:count] if count < len(node.own) else node.own
+    
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: return list(self)[index]
+            messages, offset = [], 0
+            for node, count in self.segments():
+                low, high = max(start - offset, 0), min(stop - offset, count)
+                if low < high: messages += node.own[low:high]
+                offset += count
+            return messages
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError("History index out of range")
+        node = self
+        while index < node.length: node = node.parent
+        return node.own[index - node.length]
+    
+
+    def __setitem__(self, index, message):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: raise ValueError("History slices can only be replaced in order")
+            if start < self.length:
+                raise IndexError("Messages shared with another history can't be replaced")
+            self.own[start - self.length:max(stop, start) - self.length] = list(message)
+            del self.dicts[start - self.length:]
+            return
+        index = self.own_index(index, "replaced")
+        self.own[index] = message
+        del self.dicts[index:]
     
 
-    def get(self, path):
-        """Make an authorized GET request to the OpenAI API. Returns whatever
-        JSON data the API responds with.
-        
-        :param str path: The path to request.
-        :rtype: dict or list
-        """
-        return self.request("GET", path)
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            indices = sorted(range(*index.indices(len(self))), reverse=True)
+            if indices and indices[-1] < self.length:
+                raise IndexError("Messages shared with another history can't be removed")
+            for i in indices: del self.own[i - self.length]
+            if indices: del self.dicts[indices[-1] - self.length:]
+            return
+        index = self.own_index(index, "removed")
+        del self.own[index]
+        del self.dicts[index:]
     
 
-    def post(self, path, **kwargs):
-        """Make an authorized POST request to the OpenAI API. Returns whatever
-        JSON data the API responds with.
-        
-        :param str path: The path to request.
-        :rtype: dict or list
-        """
+    def __eq__(self, other):
+        if not isinstance(other, (list, History)): return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+    
 
-        return self.request("POST", path, **kwargs)
+    def __iadd__(self, messages):
+        self.own.extend(messages)
+        return self
     
 
-    def models(self):
-        """List the models available to the user.
-        
-        :rtype: list
+    def own_index(self, index, action):
+        """Converts an index of the history to one of the messages it stores
+        itself, raising ``IndexError`` if it is out of range or shared.
+
+        :param int index: The index in the history.
+        :param str action: What is being done, for the error message.
+        :rtype: int
         """
 
-        return [m["id"] for m in self.get("models")["data"]]
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError("History index out of range")
+        if index < self.length:
+            raise IndexError(f"Messages shared with another history can't be {action}")
+        return index - self.length
+    
 
+    def insert(self, index, message):
+        """Inserts a message before an index, which must not be in the shared
+        part of the history.
 
-    def start_conversation_with_agent(self, agent, message, print=True, typed=True, loop=False):
-        """Start a conversation with an agent by sending an opening message. A
-        conversation is returned which can then be continued.
-        
-        :param Agent agent: The agent to converse with.
-        :param str message: The opening message.
-        :param bool print: Whether to print the message the agent returns.
-        :param bool typed: Whether to type out the message the agent returns.
-        :param bool loop: Whether to start a loop that continuously prompts.
-        :rtype: Conversation
+        :param int index: The index to insert before.
+        :param Message message: The message to insert.
         """
 
-        response = Response(self.post("chat/completions", json={
-            "model": agent.model,
-            "messages": [
-                {"role": "system", "content": agent.prompt.content},
-                {"role": "user", "content": message}
-            ]
-        }))
-        user_message = Message("user", message)
-        message = Message("assistant", response.message, response)
-        if print: message.print(typed=typed)
-        conversation = Conversation(self, agent, [agent.prompt, user_message, message])
-        if loop: conversation.loop(typed=typed)
-        return conversation
+        if index < 0: index = max(index + len(self), 0)
+        index = min(index, len(self))
+        if index < self.length:
+            raise IndexError("Messages can't be inserted among those shared with another history")
+        self.own.insert(index - self.length, message)
+        del self.dicts[index - self.length:]
+    
 
+    def append(self, message):
+        """Adds a message to the end of the history.
 
+        :param Message message: The message to add.
+        """
 
-class Agent:
-    """An agent that can participate in conversations.
+        self.own.append(message)
     
-    :param str model: The ID of the model to use.
-    :param str prompt: The initial prompt to use.
-    """
 
-    def __init__(self, model, prompt):
-        self.model = model
-        self.prompt = Message("system", prompt)
-    
+    def extend(self, messages):
+        """Adds messages to the end of the history.
 
-    def __repr__(self):
-        prompt = self.prompt.content
-        if len(prompt) > 40: prompt = f"{prompt[:37]}..."
-        return f"Agent({prompt})"
+        :param list messages: The messages to add.
+        """
 
+        self.own.extend(messages)
+    
 
+    def pop(self, index=-1):
+        """Removes a message the history stores itself and returns it.
 
-class Response:
-    """A response from an agent in a conversation. This is a wrapper around an
-    OpenAI completion.
-    
-    :param dict json: The JSON data from the API.
-    """
+        :param int index: The index of the message to remove.
+        :rtype: Message
+        """
 
-    def __init__(self, json):
-        self.id = json["id"]
-        self.created = json["created"]
-        self.choices = [choice["message"]["content"] for choice in json["choices"]]
-        self.prompt_tokens_used = json["usage"]["prompt_tokens"]
-        self.completion_tokens_used = json["usage"]["completion_tokens"]
-        self.tokens_used = json["usage"]["total_tokens"]
-        self.message = self.choices[0]
+        index = self.own_index(index, "removed")
+        del self.dicts[index:]
+        return self.own.pop(index)
     
 
-    def __repr__(self):
-        truncated = self.message
-        if len(truncated) > 40: truncated = f"{truncated[:37]}..."
-        return f"Response({truncated})"
+    def clear(self):
+        """Removes every message from the history - its own are discarded, and
+        the shared part is let go of rather than changed.
+        """
 
+        self.parent, self.length, self.own, self.dicts = None, 0, [], []
+    
 
+    def segments(self):
+        """Gets the histories whose messages make up this one, from the first
+        onwards, with how many of each one's own messages are included.
 
-class Message:
-    """A message in a conversation.
-    
-    :param str role: The role of the message ("assistant", "system" etc.).
-    :param str content: The content of the message.
-    :param Response response: The API response that generated this message.
-    """
+        :rtype: list
+        """
 
-    def __init__(self, role, content, response=None):
-        self.role = role
-        self.content = content
-        self.response = response
+        chain, node, count = [], self, len(self)
+        while node is not None:
+            chain.append((node, count - node.length))
+            count, node = node.length, node.parent
+        return chain[::-1]
     
 
-    def __repr__(self):
-        truncated = self.content
-        if len(truncated) > 40: truncated = f"{truncated[:37]}..."
-        return f"Message([{self.role}] {truncated})"
+    def fork(self, at=None):
+        """Creates a history which shares this one's messages, up to a point.
+
+        :param int at: The number of messages to share (by default all).
+        :rtype: History
+        """
+
+        at = len(self) if at is None else at
+        if not 0 <= at <= len(self): raise IndexError("Fork point out of range")
+        return History(parent=self, length=at)
     
 
-    def to_dict(self):
-        """Converts the message to a dictionary, in the format expected by the
-        OpenAI API.
-        
-        :rtype: dict
+    def own_dicts(self, count):
+        """Gets the API dictionaries of the first of this history's own
+        messages. These are cached, and only messages added since the last
+        call are converted. If messages have been removed, or the last one
+        converted has been replaced or edited, they are all converted again.
+
+        :param int count: The number of messages.
+        :rtype: list
         """
 
-        return {"role": self.role, "content": self.content}
+        dicts, own = self.dicts, self.own
+        if len(dicts) > len(own) or (dicts and dicts[-1] is not own[len(dicts) - 1].to_dict()):
+            dicts = []
+        if len(dicts) < count:
+            dicts = dicts + [message.to_dict() for message in own[len(dicts):count]]
+            self.dicts = dicts
+        return dicts if len(dicts) == count else dicts[:count]
+    
 
+    def to_dicts(self):
+        """Converts the history to a list of dictionaries, in the format
+        expected by the OpenAI API.
 
-    def print(self, typed=False):
-        """Prints the message to the console, optionally typing it out one
-        character at a time.
-        
-        :param bool typed: Whether to type out the message.
+        :rtype: list
         """
 
-        if not typed:
-            print(self.content)
-            return
-        for char in self.content:
-            delay = random.uniform(0.01, 0.05)
-            print(char, end="", flush=True)
-            time.sleep(delay)
-        print()
+        dicts = []
+        for node, count in self.segments(): dicts += node.own_dicts(count)
+        return dicts
 
 
 
@@ -193,56 +3915,385 @@ class Conversation:
     :param User user: The user in the conversation.
     :param Agent agent: The agent in the conversation.
     :param list messages: The initial messages in the conversation.
+    :param HistoryPolicy policy: Which messages to send with each new message.
+    :param Compaction compaction: When to summarise older messages.
+    :param SQLiteStore store: Where to save the conversation after each turn.
+    :param str id: A unique ID for the conversation (by default a random one).
     """
 
-    def __init__(self, user, agent, messages):
+    def __init__(self, user, agent, messages, policy=None, compaction=None, store=None, id=None):
+        self.id = id or uuid.uuid4().hex
         self.user = user
         self.agent = agent
         self.messages = messages
+        self.policy = policy
+        self.compaction = compaction
+        self.store = store
+        self.stored = 0
+        self.summary = None
+        self.summarized = 0
+        self.parent = None
+        self.fork_point = 0
+        self.forked = False
+        self._compacting = None
+        self._counted = (0, 0, None, None)
     
 
     def __repr__(self):
         return f"Conversation({self.agent})"
     
 
+    @property
+    def messages(self):
+        """The messages in the conversation, as a :py:class:`History`. A list
+        can be assigned, and becomes the history's messages.
+
+        :rtype: History
+        """
+
+        return self._messages
+    
+
+    @messages.setter
+    def messages(self, messages):
+        self._messages = messages if isinstance(messages, History) else History(messages)
+    
+
+    def fork(self, at=None):
+        """Creates a new conversation which continues from this one, sharing
+        its messages rather than copying them - either all of them, or those
+        up to a point. The fork has the same agent, settings and store, and
+        its own ID.
+
+        :param int at: The number of messages to keep (by default all).
+        :rtype: Conversation
+        """
+
+        branch = type(self)(
+            self.user, self.agent, self.messages.fork(at),
+            policy=self.policy, compaction=self.compaction, store=self.store
+        )
+        branch.parent, branch.fork_point = self, len(branch.messages)
+        if self.summary and self.summarized <= branch.fork_point:
+            branch.summary, branch.summarized = self.summary, self.summarized
+        self.forked = True
+        return branch
+    
+
+    def to_json(self, shared=False):
+        """Converts the conversation to a dictionary which can be saved as JSON,
+        including its agent and every message with its response.
+
+        If the conversation is a fork, and its parent is saved alongside it,
+        the messages it shares with its parent can be left out, and the parent
+        referred to instead.
+
+        :param bool shared: Whether to leave out messages shared with the parent.
+        :rtype: dict
+        """
+
+        data = {
+            "id": self.id,
+            "model": self.agent.model,
+            "parameters": self.agent.parameters,
+        }
+        messages = self.messages
+        if shared and self.parent:
+            data["parent"] = self.parent.id
+            data["fork_point"] = self.fork_point
+            messages = messages[self.fork_point:]
+        if self.forked: data["forked"] = True
+        data["messages"] = [message.to_json() for message in messages]
+        return data
+    
+
+    @classmethod
+    def from_json(cls, data, user, parent=None):
+        """Creates a conversation from a dictionary made by :py:meth:`to_json`.
+        The first message, if it is a system message, becomes the agent's
+        prompt. If the dictionary refers to a parent, the parent must be given,
+        and the conversation becomes a fork of it.
+
+        :param dict data: The conversation's data.
+        :param User user: The user to continue the conversation as.
+        :param Conversation parent: The conversation it was forked from.
+        :rtype: Conversation
+        """
+
+        messages = [Message.from_json(message) for message in data["messages"]]
+        if "parent" in data:
+            if parent is None or parent.id != data["parent"]:
+                raise ValueError(f"Conversation {data['id']} needs its parent {data['parent']}")
+            conversation = parent.fork(data["fork_point"])
+            conversation.id = data["id"]
+            conversation.messages.extend(messages)
+            conversation.forked = data.get("forked", False)
+            return conversation
+        has_prompt = messages and messages[0].role == "system"
+        agent = Agent(
+            data["model"], messages[0].content if has_prompt else "",
+            **data.get("parameters", {})
+        )
+        if has_prompt: agent.prompt = messages[0]
+        conversation = cls(user, agent, messages, id=data.get("id"))
+        conversation.forked = data.get("forked", False)
+        return conversation
+    
+
+    def save(self):
+        """Saves any new messages to the conversation's store, if it has one."""
+
+        if self.store: self.store.save(self)
+    
+
     def to_list(self):
         """Converts the conversation to a list of dictionaries, in the format
         expected by the OpenAI API.
 
+        The dictionaries are cached between calls by the conversation's
+        :py:class:`History`, and only messages appended since the last call are
+        converted. Forks of a conversation share the dictionaries of the
+        messages they share.
+
+        :rtype: list
+        """
+
+        return self.messages.to_dicts()
+    
+
+    @property
+    def prompt_tokens(self):
+        """The number of tokens the conversation's messages will take up when
+        sent to the agent's model. The count is kept up to date as messages
+        are appended, with only new messages being counted. If messages have
+        been removed, or the last one counted has been replaced or edited,
+        they are all counted again.
+
+        :rtype: int
+        """
+
+        count, total, last, content = self._counted
+        if count and (
+            count > len(self.messages) or self.messages[count - 1] is not last
+            or last.content is not content
+        ):
+            count = 0
+        if not count: total = TOKENS_PER_REPLY
+        for message in self.messages[count:]:
+            total += message.count_tokens(self.agent.model)
+        last = self.messages[-1] if self.messages else None
+        self._counted = (len(self.messages), total, last, last and last.content)
+        return total
+    
+
+    def context(self):
+        """The messages which will be sent to the agent with the next message.
+        This is all of them, unless the conversation has a history policy.
+
         :rtype: list
         """
 
-        return [message.to_dict() for message in self.messages]
+        messages = self.messages
+        if self.summary:
+            messages = [
+                *(m for m in messages[:self.summarized] if m.role == "system" or m.pinned),
+                self.summary,
+                *messages[self.summarized:]
+            ]
+        if self.policy is None: return messages
+        return self.policy.select(messages, self.agent.model)
+    
+
+    def summarize(self, cut):
+        """Summarises the conversation up to a point, using the compaction's
+        agent, and returns the summary message along with the point.
+
+        :param int cut: The index of the first message not to summarise.
+        :rtype: tuple
+        """
+
+        data = self.user.post(
+            "chat/completions", json=self.compaction.summary_json(self, cut)
+        )
+        return self.compaction.summary_message(data), cut
+    
+
+    def compact(self):
+        """Summarises older messages if the conversation has grown past its
+        compaction threshold - in the background, unless the compaction says
+        otherwise. Nothing happens if a summary is already being made.
+        """
+
+        if not self.compaction or self._compacting: return
+        cut = self.compaction.cut(self)
+        if cut is None: return
+        if self.compaction.background:
+            self._compacting = self.compaction.submit(self.summarize, cut)
+        else:
+            self.summary, self.summarized = self.summarize(cut)
+    
+
+    def apply_compaction(self):
+        """Starts using the summary made in the background, if it's ready. If
+        making the summary failed, it will be tried again after the next
+        message.
+        """
+
+        if not self._compacting or not self._compacting.done(): return
+        try:
+            self.summary, self.summarized = self._compacting.result()
+        except Exception:
+            pass
+        self._compacting = None
+    
+
+    def retract(self, *messages):
+        """Removes the messages added for a turn which didn't go through, for
+        as long as they are still the last in the conversation.
+
+        :param Message messages: The messages to remove, in order.
+        """
+
+        for message in reversed(messages):
+            if self.messages and self.messages[-1] is message: self.messages.pop()
+    
+
+    def check_context_window(self, messages=None):
+        """Checks that the messages to be sent will fit in the agent's model's
+        context window, raising a :py:class:`ContextWindowError` if not, so
+        that an oversized request isn't sent to the API to be rejected. Models
+        whose context window isn't known are not checked.
+
+        :param list messages: The messages to check (by default all of them).
+        """
+
+        window = self.user.model_info(self.agent.model).get("context_window")
+        if window is None: return
+        if messages is None or messages is self.messages:
+            tokens = self.prompt_tokens
+        else:
+            tokens = TOKENS_PER_REPLY + sum(
+                message.count_tokens(self.agent.model) for message in messages
+            )
+        if tokens > window:
+            raise ContextWindowError(
+                f"Conversation has {tokens} tokens but {self.agent.model} "
+                f"can only take {window}"
+            )
+    
+
+    def completion_json(self, stream=False):
+        """The request body for getting the agent's next message, given the
+        messages so far and the conversation's history policy. The messages are
+        checked against the model's context window first.
+
+        The body is laid out the same way every turn - generation parameters
+        in a fixed order before the messages, and each earlier message
+        serialised exactly as it was before - so that the start of each request
+        matches the last one byte for byte, and OpenAI can serve it from its
+        prompt cache.
+
+        :param bool stream: Whether the message should be streamed.
+        :rtype: dict
+        """
+
+        self.apply_compaction()
+        messages = self.context()
+        self.check_context_window(messages)
+        if messages is self.messages:
+            dicts = self.to_list()
+        else:
+            dicts = [message.to_dict() for message in messages]
+        parameters = sorted(self.agent.parameters.items())
+        json = {"model": self.agent.model, **dict(parameters), "messages": dicts}
+        if stream:
+            json["stream"] = True
+            json["stream_options"] = {"include_usage": True}
+        return json
+    
+
+    def stream(self, content, print=False, timeout=None, cancel=None):
+        """Continue a conversation by sending a message to the agent, and
+        yield the text of its reply as it is generated. The reply
+        :py:class:`Message` is added to the conversation straight away and
+        built up as text arrives, with its :py:class:`Response` attached once
+        the stream ends. If the stream fails or is abandoned, the turn's
+        messages are removed again.
+        
+        :param str content: The message to send.
+        :param bool print: Whether to print the text as it arrives.
+        :param Timeout timeout: How long the request can take (by default the user's).
+        :param CancelToken cancel: A token for abandoning the request.
+        :rtype: Generator[str]
+        """
+
+        prompt = Message("user", content)
+        message = Message("assistant", "")
+        completion = Response.empty()
+        self.messages.append(prompt)
+        try:
+            body = self.completion_json(stream=True)
+            events = self.user.stream(
+                "chat/completions", json=body, timeout=timeout, cancel=cancel
+            )
+            self.messages.append(message)
+            for event in events:
+                text = merge_chunk(completion, event)
+                if text:
+                    message.content += text
+                    if print: sys.stdout.write(text); sys.stdout.flush()
+                    yield text
+        except BaseException:
+            self.retract(prompt, message)
+            raise
+        if print: sys.stdout.write("\n")
+        message.response = Response(completion)
+        self.agent.record(message.response)
+        self.save()
+        self.compact()
     
 
-    def message(self, content, print=True, typed=True):
+    def message(self, content, print=True, typed=True, stream=False, timeout=None, cancel=None):
         """Continue a conversation by sending a message to the agent.
         
         :param str content: The message to send.
         :param bool print: Whether to print the message the agent returns.
         :param bool typed: Whether to type out the message the agent returns.
+        :param bool stream: Whether to stream the message as it is generated.
+        :param Timeout timeout: How long the request can take (by default the user's).
+        :param CancelToken cancel: A token for abandoning the request.
         :rtype: Message
         """
 
-        self.messages.append(Message("user", content))
-        response = Response(self.user.post("chat/completions", json={
-            "model": self.agent.model,
-            "messages": [
-                *self.to_list(),
-                {"role": "user", "content": content}
-            ]
-        }))
-        message = Message("assistant", response.message, response)
+        if stream:
+            for _ in self.stream(content, print=print, timeout=timeout, cancel=cancel): pass
+            return self.messages[-1]
+        prompt = Message("user", content)
+        self.messages.append(prompt)
+        try:
+            body = self.completion_json()
+            data = self.user.post(
+                "chat/completions", json=body, raw=True, timeout=timeout, cancel=cancel
+            )
+        except BaseException:
+            self.retract(prompt)
+            raise
+        response = Response(data, self.user.codec)
+        message = Message("assistant", None, response)
+        self.agent.record(response)
         if print: message.print(typed=typed)
         self.messages.append(message)
+        self.save()
+        self.compact()
         return message
 
 
-    def loop(self, typed=True):
+    def loop(self, typed=True, stream=False):
         """Continuously prompt the user for messages and respond to them until
         the user types "exit".
         
         :param bool typed: Whether to type out the messages the agent returns.
+        :param bool stream: Whether to stream messages as they are generated.
         """
 
         while True:
@@ -250,7 +4301,7 @@ class Conversation:
             message = input("> ")
             print()
             if message == "exit": break
-            self.message(message, typed=typed)
+            self.message(message, typed=typed, stream=stream)
 
 
     def print(self):
@@ -270,4 +4321,163 @@ class Conversation:
         :rtype: int
         """
 
-        return sum(message.response.tokens_used for message in self.messages if message.response)
\ No newline at end of file
+        return sum(message.response.tokens_used for message in self.messages if message.response)
+    
+
+    @property
+    def cached_tokens_used(self):
+        """The number of prompt tokens in the conversation which were served
+        from OpenAI's prompt cache.
+
+        :rtype: int
+        """
+
+        return sum(
+            message.response.cached_tokens_used
+            for message in self.messages if message.response
+        )
+    
+
+    @property
+    def cache_hit_rate(self):
+        """The fraction of prompt tokens in the conversation which were served
+        from OpenAI's prompt cache.
+
+        :rtype: float
+        """
+
+        responses = [message.response for message in self.messages if message.response]
+        used = sum(response.prompt_tokens_used for response in responses)
+        cached = sum(response.cached_tokens_used for response in responses)
+        return cached / used if used else 0
+
+
+
+class AsyncConversation(Conversation):
+    """A conversation between a user and an agent, where messages are sent
+    without blocking. The user should be an :py:class:`AsyncUser`.
+
+    :param AsyncUser user: The user in the conversation.
+    :param Agent agent: The agent in the conversation.
+    :param list messages: The initial messages in the conversation.
+    """
+
+    async def stream(self, content, print=False, timeout=None):
+        """Continue a conversation by sending a message to the agent, and
+        yield the text of its reply as it is generated. The reply
+        :py:class:`Message` is added to the conversation straight away and
+        built up as text arrives, with its :py:class:`Response` attached once
+        the stream ends. If the stream fails or is abandoned, the turn's
+        messages are removed again.
+        
+        :param str content: The message to send.
+        :param bool print: Whether to print the text as it arrives.
+        :param Timeout timeout: How long the request can take (by default the user's).
+        :rtype: AsyncGenerator[str]
+        """
+
+        prompt = Message("user", content)
+        message = Message("assistant", "")
+        completion = Response.empty()
+        self.messages.append(prompt)
+        try:
+            body = self.completion_json(stream=True)
+            events = self.user.stream("chat/completions", json=body, timeout=timeout)
+            self.messages.append(message)
+            async for event in events:
+                text = merge_chunk(completion, event)
+                if text:
+                    message.content += text
+                    if print: sys.stdout.write(text); sys.stdout.flush()
+                    yield text
+        except BaseException:
+            self.retract(prompt, message)
+            raise
+        if print: sys.stdout.write("\n")
+        message.response = Response(completion)
+        self.agent.record(message.response)
+        self.save()
+        await self.compact()
+
+
+    async def summarize(self, cut):
+        """Summarises the conversation up to a point, using the compaction's
+        agent, and returns the summary message along with the point.
+
+        :param int cut: The index of the first message not to summarise.
+        :rtype: tuple
+        """
+
+        data = await self.user.post(
+            "chat/completions", json=self.compaction.summary_json(self, cut)
+        )
+        return self.compaction.summary_message(data), cut
+
+
+    async def compact(self):
+        """Summarises older messages if the conversation has grown past its
+        compaction threshold - in a separate task, unless the compaction says
+        otherwise. Nothing happens if a summary is already being made.
+        """
+
+        if not self.compaction or self._compacting: return
+        cut = self.compaction.cut(self)
+        if cut is None: return
+        if self.compaction.background:
+            self._compacting = asyncio.create_task(self.summarize(cut))
+        else:
+            self.summary, self.summarized = await self.summarize(cut)
+
+
+    async def message(self, content, print=False, typed=False, stream=False, timeout=None):
+        """Continue a conversation by sending a message to the agent. If the
+        task doing so is cancelled, the request is abandoned and its
+        connection released.
+        
+        :param str content: The message to send.
+        :param bool print: Whether to print the message the agent returns.
+        :param bool typed: Whether to type out the message the agent returns.
+        :param bool stream: Whether to stream the message as it is generated.
+        :param Timeout timeout: How long the request can take (by default the user's).
+        :rtype: Message
+        """
+
+        if stream:
+            async for _ in self.stream(content, print=print, timeout=timeout): pass
+            return self.messages[-1]
+        prompt = Message("user", content)
+        self.messages.append(prompt)
+        try:
+            body = self.completion_json()
+            data = await self.user.post(
+                "chat/completions", json=body, raw=True, timeout=timeout
+            )
+        except BaseException:
+            self.retract(prompt)
+            raise
+        response = Response(data, self.user.codec)
+        message = Message("assistant", None, response)
+        self.agent.record(response)
+        if print: await message.print_async(typed=typed)
+        self.messages.append(message)
+        self.save()
+        await self.compact()
+        return message
+
+
+    async def loop(self, typed=True, stream=False):
+        """Continuously prompt the user for messages and respond to them until
+        the user types "exit". Input is read in a worker thread so that the
+        event loop is free to run other conversations in the meantime.
+        
+        :param bool typed: Whether to type out the messages the agent returns.
+        :param bool stream: Whether to stream messages as they are generated.
+        """
+
+        event_loop = asyncio.get_running_loop()
+        while True:
+            print()
+            message = await event_loop.run_in_executor(None, input, "> ")
+            print()
+            if message == "exit": break
+            await self.message(message, print=True, typed=typed, stream=stream)
@@ -27,4 +27,5 @@ setup(
     keywords="LLM OpenAI GPT",
     py_modules=["oratio"],
     install_requires=["requests"],
+    extras_require={"async": ["aiohttp"], "tokens": ["tiktoken"], "semantic": ["numpy"], "fast": ["orjson"]},
 )